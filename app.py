@@ -1,18 +1,24 @@
 import streamlit as st
-import uuid
+import hmac
+import secrets
 from langchain_community.chat_message_histories import StreamlitChatMessageHistory
 from src.openai_chain import RAGChain
-from src.utils import save_chat_history, load_chat_history, get_saved_sessions
+from src.utils import save_chat_history_async, load_chat_history, get_saved_sessions
 from src import streamlitUi # <-- Import the new UI module
 
 # --- Page Configuration ---
 st.set_page_config(page_title="INVOKE's Multimodal RAG LLM Chatbot DM Speciality Tool", layout="wide")
 
+@st.cache_resource
+def _app_password() -> bytes:
+    """Reads the app password from st.secrets once per process (the script itself re-runs on every rerun)."""
+    return st.secrets["APP_PASSWORD"].encode()
+
 def check_password():
     """Returns `True` if the user enters the correct password."""
     # ... (This function remains exactly the same as before) ...
     def password_entered():
-        if st.session_state["password"] == st.secrets["APP_PASSWORD"]:
+        if hmac.compare_digest(st.session_state["password"].encode(), _app_password()):
             st.session_state["password_correct"] = True
             del st.session_state["password"]
         else:
@@ -24,18 +30,102 @@ def check_password():
         st.error("😕 Password incorrect.")
     return False
 
+# (filter key, preamble fragment) pairs, in the order they appear in the prompt
+_FILTER_TEMPLATES = (
+    ('campaign_objective', "for the '{}' objective"),
+    ('target_market', "targeting the '{}' market"),
+    ('industry', "in the '{}' industry"),
+    ('ad_format', "using the '{}' format"),
+)
+
+# Number of most recent messages kept in the live chat history (and rendered)
+HISTORY_WINDOW = 40
+
+@st.cache_data(ttl=30, show_spinner=False)
+def _saved_sessions():
+    """Caches the S3 session listing so sidebar redraws don't hit the network on every rerun."""
+    return get_saved_sessions()
+
+def get_rag_chain(session_id: str, chat_history):
+    """
+    Builds the RAG chain once per chat session instead of on every user turn.
+
+    Kept in st.session_state rather than st.cache_resource: the chain holds the
+    session's chat_memory and filters, so it must not be shared between browser tabs.
+    """
+    key = f"rag_chain_{session_id}"
+    if key not in st.session_state:
+        st.session_state[key] = RAGChain(chat_history)
+    return st.session_state[key]
+
+# Persist to S3 every N completed turns, and whenever the user leaves the session
+SAVE_EVERY_N_TURNS = 5
+
+def _saved_lens() -> dict:
+    """
+    session_id -> number of messages confirmed persisted to S3.
+
+    A plain dict kept in session_state, so save callbacks can update it from the
+    worker thread without touching st.session_state itself.
+    """
+    return st.session_state.setdefault("saved_lens", {})
+
+def _session_messages(session_id: str) -> list:
+    """The session's full transcript: archived turns followed by the live window."""
+    return st.session_state.get(f"archived_{session_id}", []) + st.session_state.get(f"history_{session_id}", [])
+
+def _save_in_background(session_id: str):
+    """Queues an upload of the session's full transcript (archived + live) on the save pool."""
+    messages = _session_messages(session_id)
+    saved_lens = _saved_lens()
+    # Only messages past the persisted count are uploaded (see save_chat_history)
+    future = save_chat_history_async(
+        session_id, messages, saved_lens.get(session_id, 0), title=st.session_state.get(f"title_{session_id}")
+    )
+
+    def record_saved(f):
+        # Advance only on success; a failed save returns the old count and is retried next time
+        if f.exception() is None:
+            saved_lens[session_id] = max(saved_lens.get(session_id, 0), f.result())
+            # Drop the cached listing once the new metadata is in S3, not while the upload is pending
+            _saved_sessions.clear()
+
+    future.add_done_callback(record_saved)
+    st.session_state._turns_since_save = 0
+    return future
+
+def _flush_chat_history():
+    """
+    Saves any not-yet-persisted turns of the active session before switching away from it.
+
+    Returns:
+        Future | None: The queued save, or None if everything was already persisted.
+    """
+    session_id = st.session_state.get("session_id")
+    if session_id and len(_session_messages(session_id)) > _saved_lens().get(session_id, 0):
+        return _save_in_background(session_id)
+    return None
+
 def run_app():
     """
     The main orchestrator for the application.
     """
     # --- Session State Initialization ---
     if "session_id" not in st.session_state or st.session_state.session_id is None:
-        st.session_state.session_id = str(uuid.uuid4())
+        st.session_state.session_id = secrets.token_hex(16)
+        # A freshly generated id has nothing stored remotely, so skip the load.
+        st.session_state.history_loaded_for = st.session_state.session_id
 
     # --- Render UI Components from ui.py ---
     with st.sidebar:
-        saved_sessions = get_saved_sessions()
-        streamlitUi.render_sidebar(saved_sessions)
+        streamlitUi.render_sidebar(on_leave=_flush_chat_history)
+
+        # Paint a placeholder first so the sidebar isn't blank while S3 is listed
+        sessions_placeholder = st.empty()
+        sessions_placeholder.markdown("⏳ Loading conversations…")
+        saved_sessions = _saved_sessions()
+        with sessions_placeholder.container():
+            streamlitUi.render_session_list(saved_sessions, on_leave=_flush_chat_history)
 
         st.markdown("---")
 
@@ -44,13 +134,33 @@ def run_app():
 
     # Render the main chat display
     history_key = f"history_{st.session_state.session_id}"
+    archive_key = f"archived_{st.session_state.session_id}"
     chat_history = StreamlitChatMessageHistory(key=history_key)
-    if not chat_history.messages:
-        chat_history.messages = load_chat_history(st.session_state.session_id)
+    # Load from S3 once per selected session rather than on every rerun with an empty history
+    if st.session_state.get("history_loaded_for") != st.session_state.session_id:
+        parked = streamlitUi.take_parked_transcript(st.session_state.session_id)
+        if parked is not None:
+            # Left while its save was in flight; S3 may not have all of it yet, so resume from memory
+            st.session_state[archive_key], chat_history.messages = parked
+        elif not chat_history.messages:
+            messages = load_chat_history(st.session_state.session_id) or []
+            _saved_lens()[st.session_state.session_id] = len(messages)
+            # Keep the stored title; the stored questions include the prompt preamble
+            for session in saved_sessions:
+                if session['session_id'] == st.session_state.session_id:
+                    st.session_state[f"title_{st.session_state.session_id}"] = session['title']
+            # Only the most recent window stays live; older turns are archived until requested
+            st.session_state[archive_key] = messages[:-HISTORY_WINDOW]
+            chat_history.messages = messages[-HISTORY_WINDOW:]
+        st.session_state.history_loaded_for = st.session_state.session_id
+    archived = st.session_state.get(archive_key, [])
     
     chat_container = st.container()
     with chat_container:
-        streamlitUi.render_chat_interface(chat_history)
+        if streamlitUi.render_chat_interface(chat_history, earlier_count=len(archived)):
+            chat_history.messages = archived[-HISTORY_WINDOW:] + chat_history.messages
+            st.session_state[archive_key] = archived[:-HISTORY_WINDOW]
+            st.rerun()
     
     # Render filters and get their current values
     #filters = streamlitUi.render_filters()
@@ -59,19 +169,16 @@ def run_app():
     if user_input := st.chat_input("Ask about your active ad campaigns..."):
         # Display user message immediately
         st.chat_message("human").write(user_input)
+        # The session is titled after the user's own first question, not the augmented prompt
+        st.session_state.setdefault(f"title_{st.session_state.session_id}", user_input[:60])
         
         with st.spinner("Analyzing data and generating response..."):
             # Construct the prompt using filter values
-            context_parts = []
-            if filters['campaign_objective'] != "All":
-                context_parts.append(f"for the '{filters['campaign_objective']}' objective")
-            if filters['target_market'] != "All":
-                context_parts.append(f"targeting the '{filters['target_market']}' market")
-            if filters['industry'] != "All":
-                context_parts.append(f"in the '{filters['industry']}' industry")
-            if filters['ad_format'] != "All":
-                context_parts.append(f"using the '{filters['ad_format']}' format")
-
+            context_parts = [
+                template.format(value)
+                for key, template in _FILTER_TEMPLATES
+                if (value := filters[key]) != "All"
+            ]
             context_preamble = ""
             if context_parts:
                 context_preamble = "Analyze the following query " + " ".join(context_parts) + ". "
@@ -79,12 +186,17 @@ def run_app():
             final_input = f"{context_preamble}Answer in {filters['output_language']}. User question: {user_input}"
             
             # Execute RAG chain
-            rag_chain = RAGChain(chat_history)
-            response = rag_chain.run(final_input)
-            
-            # Display AI response and save history
-            st.chat_message("ai").write(response)
-            save_chat_history(st.session_state.session_id, chat_history.messages)
+            rag_chain = get_rag_chain(st.session_state.session_id, chat_history)
+            # The wrapper snapshots its list on creation; point the cached chain at this rerun's one
+            rag_chain.chat_memory = chat_history
+            rag_chain.filters = filters
+            # Stream the AI response as it is generated, then save history
+            with st.chat_message("ai"):
+                st.write_stream(rag_chain.stream(final_input, question=user_input))
+            # Debounced save of the full transcript, not just the live window
+            st.session_state._turns_since_save = st.session_state.get("_turns_since_save", 0) + 1
+            if st.session_state._turns_since_save >= SAVE_EVERY_N_TURNS:
+                _save_in_background(st.session_state.session_id)
 
 # --- Application Gatekeeper ---
 if check_password():
@@ -1,6 +1,7 @@
 # src/vectorstore.py
 
 import os
+import atexit
 import shutil
 from dotenv import load_dotenv
 
@@ -23,7 +24,7 @@ class VectorDB:
     
     It does NOT contain logic to index new documents or delete the index.
     """
-    def __init__(self):
+    def __init__(self, cleanup_on_exit=False):
         config = load_config()
         self.cache_dir = './.cache/database'
         os.makedirs(self.cache_dir, exist_ok=True)
@@ -54,6 +55,10 @@ class VectorDB:
         )
         self.record_manager.create_schema()
 
+        # Cleanup is opt-in and explicit; the record manager cache must survive transient instances.
+        if cleanup_on_exit:
+            atexit.register(self.close)
+
     def as_retriever(self):
         """
         Returns the vector store instance as a retriever for the RAG chain.
@@ -62,9 +67,9 @@ class VectorDB:
         # For example: search_kwargs={'k': 5}
         return self.vectorstore.as_retriever()
 
-    def __del__(self):
+    def close(self):
         """
-        Cleans up the local cache directory when the object is destroyed.
+        Removes the local cache directory. Call explicitly (or pass cleanup_on_exit=True).
         """
         if os.path.exists(self.cache_dir):
             shutil.rmtree(self.cache_dir)
\ No newline at end of file
@@ -1,4 +1,5 @@
 import streamlitUi as st
+import hmac
 import yaml
 import uuid
 from langchain_community.chat_message_histories import StreamlitChatMessageHistory
@@ -19,7 +20,7 @@ st.set_page_config(page_title="Meta Ads RAG Chatbot", layout="wide")
 def check_password():
     """Returns `True` if the user enters the correct password."""
     def password_entered():
-        if st.session_state["password"] == st.secrets["APP_PASSWORD"]:
+        if hmac.compare_digest(st.session_state["password"].encode(), st.secrets["APP_PASSWORD"].encode()):
             st.session_state["password_correct"] = True
             del st.session_state["password"]
         else:
@@ -1,4 +1,5 @@
 import streamlitUi as st
+import hmac
 import yaml
 import uuid
 from langchain_community.chat_message_histories import StreamlitChatMessageHistory
@@ -12,7 +13,7 @@ def check_password():
     """Returns `True` if the user enters the correct password."""
     def password_entered():
         """Checks whether a password entered by the user is correct."""
-        if st.session_state["password"] == st.secrets["APP_PASSWORD"]:
+        if hmac.compare_digest(st.session_state["password"].encode(), st.secrets["APP_PASSWORD"].encode()):
             st.session_state["password_correct"] = True
             del st.session_state["password"]  # Don't store password.
         else:
@@ -1,81 +1,408 @@
 import os
+import io
+import gzip
 import json
+import time
+import tempfile
+import functools
+import threading
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
+import boto3
+from boto3.s3.transfer import TransferConfig
 import pandas as pd
 
 # -------------------------------------------------------------------
 # Helper Functions
 # -------------------------------------------------------------------
+@functools.lru_cache(maxsize=None)
+def compile_path(key_path):
+    """
+    Compiles a dot-notation path once into an accessor function, so repeated lookups
+    skip the split and per-level int parsing. Numeric keys index into lists.
+    """
+    steps = []
+    for key in key_path.split('.'):
+        try:
+            steps.append((key, int(key)))
+        except ValueError:
+            steps.append((key, None))
+    steps = tuple(steps)
+
+    def get(data_dict, default=None):
+        val = data_dict
+        try:
+            for key, index in steps:
+                if isinstance(val, list):
+                    if index is None:
+                        return default
+                    val = val[index]
+                else:
+                    val = val[key]
+            return val
+        except (KeyError, TypeError, IndexError):
+            return default
+
+    return get
+
+
 def safe_get(data_dict, key_path, default=None):
     """Safely get nested dictionary or list values using dot notation."""
-    keys = key_path.split('.')
-    val = data_dict
-    try:
-        for key in keys:
-            if isinstance(val, list):
-                try:
-                    key = int(key)
-                except ValueError:
-                    return default
-            val = val[key]
-        return val
-    except (KeyError, TypeError, IndexError):
-        return default
+    return compile_path(key_path)(data_dict, default)
+
+
+_get_asset_videos = compile_path("asset_feed_spec.videos")
+_get_story_video_data = compile_path("object_story_spec.video_data")
+
+
+def _scan_creative(creative):
+    """
+    Single pass over a creative: returns (format_category, image_hashes, video_ids).
+    Classification follows the same precedence as before: Video/Reel, Carousel, Static Image.
+    """
+    if not creative:
+        return "Unknown", [], []
+    story = creative.get('object_story_spec') or {}
+    link_data = story.get('link_data') or {}
+    feed = creative.get('asset_feed_spec') or {}
+    feed_videos = feed.get('videos') or []
+    children = link_data.get('child_attachments') or []
+    story_video_id = (story.get('video_data') or {}).get('video_id')
+
+    image_hashes = [att['image_hash'] for att in children if 'image_hash' in att]
+    if creative.get('image_hash'):
+        image_hashes.append(creative['image_hash'])
+    video_ids = [v['video_id'] for v in feed_videos if 'video_id' in v]
+    if story_video_id:
+        video_ids.append(story_video_id)
+
+    if feed_videos or story_video_id:
+        category = "Video/Reel"
+    elif children:
+        category = "Carousel"
+    elif (creative.get('image_url') or feed.get('images') or creative.get('image_hash')
+          or creative.get('thumbnail_url') or story.get('photo_data')):
+        category = "Static Image"
+    else:
+        category = "Unknown"
+    return category, image_hashes, video_ids
 
 
 def determine_format_category(ad_creative):
     """Classify ad creative into Video, Carousel, or Static Image."""
-    if not ad_creative:
-        return "Unknown"
-    if safe_get(ad_creative, 'asset_feed_spec.videos') or safe_get(ad_creative, 'object_story_spec.video_data.video_id'):
-        return "Video/Reel"
-    if safe_get(ad_creative, 'object_story_spec.link_data.child_attachments'):
-        return "Carousel"
-    if safe_get(ad_creative, 'image_url') or safe_get(ad_creative, 'asset_feed_spec.images') or safe_get(ad_creative, 'image_hash') or safe_get(ad_creative, 'thumbnail_url') or safe_get(ad_creative, 'object_story_spec.photo_data'):
-        return "Static Image"
-    return "Unknown"
-
-
-def fetch_image_urls(hashes, access_token, ad_account_id, api_version):
-    """Resolve image hashes into actual image URLs."""
+    return _scan_creative(ad_creative)[0]
+
+
+API_VERSION = "v21.0"
+BASE_URL = f"https://graph.facebook.com/{API_VERSION}/"
+
+
+GRAPH_USAGE_THRESHOLD = 80  # percent of a rate-limit bucket before we slow down
+GRAPH_MAX_WAIT_SECONDS = 5 * 60  # longer lockouts fail the remaining lookups instead of stalling the run
+
+# One resume time shared by every worker, so a throttled response pauses the whole pool once
+_GRAPH_PAUSE_LOCK = threading.Lock()
+_graph_resume_at = 0.0
+
+
+def _usage_delay(res):
+    """Seconds to back off for, from the usage buckets Graph reports on a response."""
+    header = res.headers.get('X-Business-Use-Case-Usage')
+    if not header:
+        return 0
+    try:
+        buckets = [b for entries in orjson.loads(header).values() for b in entries]
+    except (orjson.JSONDecodeError, AttributeError, TypeError):
+        return 0
+    usage = max((max(b.get('call_count', 0), b.get('total_cputime', 0), b.get('total_time', 0))
+                 for b in buckets), default=0)
+    regain_minutes = max((b.get('estimated_time_to_regain_access', 0) for b in buckets), default=0)
+    if regain_minutes:
+        return regain_minutes * 60
+    if usage > GRAPH_USAGE_THRESHOLD:
+        return (usage - GRAPH_USAGE_THRESHOLD) / (100 - GRAPH_USAGE_THRESHOLD) * 30
+    return 0
+
+
+def _throttle_on_usage(res):
+    """Pushes back the shared resume time when Graph reports a usage bucket above the threshold."""
+    global _graph_resume_at
+    delay = _usage_delay(res)
+    if not delay:
+        return
+    with _GRAPH_PAUSE_LOCK:
+        resume_at = time.monotonic() + delay
+        if resume_at > _graph_resume_at:
+            _graph_resume_at = resume_at
+            print(f"Graph API throttled; pausing requests for {delay:.0f}s...")
+
+
+def _wait_for_graph():
+    """
+    Blocks until the shared resume time. The sleep happens under the lock, so one worker
+    waits while the rest queue behind it; raises if the wait exceeds GRAPH_MAX_WAIT_SECONDS.
+    """
+    with _GRAPH_PAUSE_LOCK:
+        remaining = _graph_resume_at - time.monotonic()
+        if remaining > GRAPH_MAX_WAIT_SECONDS:
+            raise RuntimeError(f"Graph API access blocked for another {remaining / 60:.0f} min")
+        if remaining > 0:
+            time.sleep(remaining)
+
+
+def _make_session():
+    """
+    Keep-alive session shared by every Graph API call. Connection errors, throttling (429)
+    and 5xx responses are retried with jittered exponential backoff at the adapter layer,
+    so parallel workers throttled together don't retry in lockstep.
+    """
+    retries = Retry(
+        total=5,
+        backoff_factor=0.5,
+        backoff_jitter=0.5,  # up to 0.5s random extra per wait (urllib3 >= 2)
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=frozenset({"GET", "POST"}),  # batch POSTs are read-only lookups
+        raise_on_status=False,  # hand the last response to raise_for_status()
+    )
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(pool_connections=20, pool_maxsize=50, max_retries=retries))
+    return session
+
+
+_SESSION = _make_session()
+
+
+def _graph_request(method, url, **kwargs):
+    """Graph API call over the pooled session; raises on a final non-2xx response."""
+    _wait_for_graph()
+    res = _SESSION.request(method, url, **kwargs)
+    _throttle_on_usage(res)
+    res.raise_for_status()
+    return res
+
+
+GRAPH_BATCH_SIZE = 50  # max sub-requests per Graph API batch call (also used for hash chunks)
+GRAPH_FETCH_THREADS = 8  # concurrent Graph lookups per resolver (image chunks, video batches)
+
+
+def fetch_image_urls(hashes, access_token, ad_account_id):
+    """Resolve image hashes into actual image URLs, 50 hashes per request."""
     if not hashes:
         return {}
     print(f"Step 2: Resolving {len(hashes)} image hashes...")
     hash_url_map = {}
-    BASE_URL = f"https://graph.facebook.com/{api_version}/"
     url = f"{BASE_URL}{ad_account_id}/adimages"
-    params = {'fields': 'url,hash', 'hashes': json.dumps(list(hashes)), 'access_token': access_token}
-    try:
-        res = requests.get(url, params=params)
-        res.raise_for_status()
-        for item in res.json().get('data', []):
-            hash_url_map[item['hash']] = item['url']
-    except Exception as e:
-        print("Error fetching image URLs:", e)
+
+    def fetch_chunk(chunk):
+        # Chunked so the hashes querystring stays well under URL length limits
+        params = {'fields': 'url,hash', 'hashes': json.dumps(chunk), 'access_token': access_token}
+        try:
+            res = _graph_request('GET', url, params=params)
+            return orjson.loads(res.content).get('data', [])
+        except Exception as e:
+            print(f"Error fetching URLs for {len(chunk)} image hashes:", e)
+            return []
+
+    hashes = list(hashes)
+    chunks = [hashes[i:i + GRAPH_BATCH_SIZE] for i in range(0, len(hashes), GRAPH_BATCH_SIZE)]
+    with ThreadPoolExecutor(max_workers=GRAPH_FETCH_THREADS) as executor:
+        for items in executor.map(fetch_chunk, chunks):
+            for item in items:
+                hash_url_map[item['hash']] = item['url']
     return hash_url_map
 
 
-def fetch_video_urls(video_ids, access_token, api_version):
-    """Resolve video IDs into direct source URLs."""
+def fetch_video_urls(video_ids, access_token):
+    """Resolve video IDs into direct source URLs, up to 50 per Graph API batch request."""
     if not video_ids:
         return {}
     print(f"Step 2B: Resolving {len(video_ids)} video IDs...")
     video_url_map = {}
-    BASE_URL = f"https://graph.facebook.com/{api_version}/"
-    for vid in video_ids:
-        url = f"{BASE_URL}{vid}"
-        params = {'fields': 'source', 'access_token': access_token}
+
+    def fetch_chunk(chunk):
+        batch = [{'method': 'GET', 'relative_url': f"{vid}?fields=source"} for vid in chunk]
+        resolved = {}
         try:
-            res = requests.get(url, params=params)
-            res.raise_for_status()
-            data = res.json()
-            if 'source' in data:
-                video_url_map[vid] = data['source']
+            res = _graph_request('POST', BASE_URL, data={'access_token': access_token, 'batch': json.dumps(batch)})
+            # One entry per sub-request, in order; null if that sub-request timed out
+            for vid, item in zip(chunk, orjson.loads(res.content)):
+                if not item or item.get('code') != 200:
+                    print(f"Skipping {vid}:", item.get('body') if item else "no response")
+                    continue
+                data = orjson.loads(item['body'])
+                if 'source' in data:
+                    resolved[vid] = data['source']
         except Exception as e:
-            print(f"Skipping {vid}:", e)
+            print(f"Skipping batch of {len(chunk)} videos:", e)
+        return resolved
+
+    video_ids = list(video_ids)
+    chunks = [video_ids[i:i + GRAPH_BATCH_SIZE] for i in range(0, len(video_ids), GRAPH_BATCH_SIZE)]
+    with ThreadPoolExecutor(max_workers=GRAPH_FETCH_THREADS) as executor:
+        for resolved in executor.map(fetch_chunk, chunks):
+            video_url_map.update(resolved)
     return video_url_map
 
+# -------------------------------------------------------------------
+# Flattening (Step 4)
+# -------------------------------------------------------------------
+# json_normalize column (dot-separated path) -> CSV column
+AD_COLUMNS = {
+    "id": "ad_id",
+    "name": "ad_name",
+    "status": "ad_status",
+    "format_category": "format_category",
+    "campaign.id": "campaign_id",
+    "campaign.name": "campaign_name",
+    "campaign.objective": "campaign_objective",
+    "adset.id": "adset_id",
+    "adset.name": "adset_name",
+    "adset.optimization_goal": "optimization_goal",
+    "creative.title": "creative_title",
+    "creative.body": "creative_body",
+    "creative.image_url": "creative_image_url",
+    "creative.thumbnail_url": "creative_thumbnail_url",
+    "creative.object_story_spec.text_data.message": "copy_text",
+    "creative.object_story_spec.link_data.link": "link_url",
+}
+# Insights metric -> dtype, in CSV column order. Counts use Int32 (half of int64);
+# money and ratios stay float64 so the CSV values are written exactly as before
+METRICS = {
+    "spend": "float64", "impressions": "Int32", "clicks": "Int32",
+    "ctr": "float64", "cpc": "float64", "cpm": "float64",
+}
+CONVERSION_ACTIONS = ["offsite_conversion", "purchase"]
+# Low-cardinality strings: stored as category codes instead of one object per row
+CATEGORY_COLUMNS = ["format_category", "ad_status", "campaign_objective", "optimization_goal", "adset_name"]
+
+
+def _numeric(series, default=0):
+    return pd.to_numeric(series, errors="coerce").fillna(default)
+
+
+def flatten_ads(ads_data):
+    """Flatten ads (with nested campaign/adset/creative/insights) into one row per ad."""
+    raw = pd.json_normalize(ads_data, sep=".")
+    df = raw.reindex(columns=list(AD_COLUMNS)).rename(columns=AD_COLUMNS)
+
+    # First insights row per ad (the time range yields at most one); {} when absent
+    ins_rows = raw["insights.data"] if "insights.data" in raw else pd.Series(None, index=raw.index, dtype=object)
+    ins = pd.json_normalize([rows[0] if isinstance(rows, list) and rows else {} for rows in ins_rows])
+    ins = ins.reindex(columns=[*METRICS, "actions", "purchase_roas"])
+    ins.index = df.index
+
+    for col, dtype in METRICS.items():
+        df[col] = _numeric(ins[col]).astype(dtype)
+
+    roas = ins["purchase_roas"].map(lambda v: v[0].get("value") if isinstance(v, list) and v else None)
+    df["roas"] = _numeric(roas).astype("float64")
+
+    # Conversions: explode actions to one row each (indexed by ad row), keep conversion
+    # types with a vectorized isin, then sum per ad; Int32 halves the column vs int64
+    actions = ins["actions"].explode().dropna()
+    actions = pd.DataFrame(actions.tolist(), index=actions.index).reindex(columns=["action_type", "value"])
+    conversions = actions.loc[actions["action_type"].isin(CONVERSION_ACTIONS), "value"]
+    df["conversions"] = (
+        _numeric(conversions).astype("Int32")
+        .groupby(level=0).sum()
+        .reindex(df.index, fill_value=0)
+        .astype("Int32")
+    )
+    clicks = df["clicks"]
+    df["conversion_rate"] = (
+        (df["conversions"].astype(float) / clicks.astype(float) * 100)
+        .where(clicks > 0, 0.0)
+        .astype("float64")
+    )
+
+    for col in CATEGORY_COLUMNS:
+        df[col] = df[col].astype("category")
+    return df
+
+
+CSV_CHUNK_ROWS = 5000  # ads flattened per DataFrame when writing the CSV
+
+
+def write_ads_csv(ads_data, f, chunk_rows=CSV_CHUNK_ROWS):
+    """
+    Streams the flattened ads to an open text file in fixed-size chunks, so only one
+    chunk's intermediate frames are alive at a time. Returns the number of rows written.
+    """
+    rows = 0
+    for start in range(0, max(len(ads_data), 1), chunk_rows):
+        df = flatten_ads(ads_data[start:start + chunk_rows])
+        df.to_csv(f, index=False, header=start == 0)
+        rows += len(df)
+    return rows
+
+
+# -------------------------------------------------------------------
+# Output
+# -------------------------------------------------------------------
+S3_JSON_KEY = os.getenv("S3_KEY", "data/dataset.json")  # same key ingest.py reads
+S3_CSV_KEY = os.getenv("S3_CSV_KEY", "data/meta_ads_data.csv")
+S3_TRANSFER_CONFIG = TransferConfig(multipart_chunksize=8 * 1024 * 1024, max_concurrency=8)
+# Upload bodies are spooled in memory up to this size, then spill to a temporary file
+S3_SPOOL_BYTES = 32 * 1024 * 1024
+
+
+@functools.cache
+def get_s3_client():
+    """S3 client built from the same env credentials as ingest.py and src/utils.py."""
+    return boto3.client(
+        "s3",
+        aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"),
+        aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"),
+        region_name=os.getenv("AWS_DEFAULT_REGION"),
+    )
+
+
+def write_dataset_json(ads_data, f):
+    """
+    Writes ads as a JSON array to a binary file, encoding one ad at a time (one per line)
+    so the full document is never buffered. orjson always emits UTF-8.
+    """
+    f.write(b"[")
+    for i, ad in enumerate(ads_data):
+        f.write(b",\n" if i else b"\n")
+        f.write(orjson.dumps(ad))
+    f.write(b"\n]\n")
+
+
+def upload_stream(s3, bucket_name, key, content_type, write, compress=False):
+    """
+    Uploads whatever `write(f)` writes to a binary file object, returning its result.
+
+    The body goes through a SpooledTemporaryFile, so memory use stays bounded by
+    S3_SPOOL_BYTES however large the output is, and is then sent as a concurrent
+    multipart upload. With `compress`, it is gzipped on the way into the spool and
+    stored with Content-Encoding: gzip.
+    """
+    extra_args = {"ContentType": content_type}
+    with tempfile.SpooledTemporaryFile(max_size=S3_SPOOL_BYTES) as f:
+        if compress:
+            with gzip.GzipFile(fileobj=f, mode="wb", compresslevel=6) as gz:
+                result = write(gz)
+            extra_args["ContentEncoding"] = "gzip"
+        else:
+            result = write(f)
+        f.seek(0)
+        s3.upload_fileobj(f, bucket_name, key, ExtraArgs=extra_args, Config=S3_TRANSFER_CONFIG)
+    return result
+
+
+def write_ads_csv_bytes(ads_data, f):
+    """write_ads_csv onto a binary file (UTF-8 with BOM, as the local CSV is written)."""
+    text = io.TextIOWrapper(f, encoding="utf-8-sig", newline="")
+    rows = write_ads_csv(ads_data, text)
+    text.detach()  # flushes, and leaves f open for the caller
+    return rows
+
+
 # -------------------------------------------------------------------
 # Main Data Fetch Script
 # -------------------------------------------------------------------
@@ -84,7 +411,6 @@ def get_data_script():
 
     ACCESS_TOKEN = os.getenv("META_ACCESS_TOKEN")
     AD_ACCOUNT_ID = os.getenv("META_AD_ACCOUNT_ID")
-    API_VERSION = "v21.0"
 
     if not all([ACCESS_TOKEN, AD_ACCOUNT_ID]):
         print("❌ Missing Meta Ads credentials in .env file.")
@@ -99,7 +425,7 @@ def get_data_script():
         "adset{id,name,optimization_goal,status,daily_budget,"
         "targeting{geo_locations,countries,age_min,age_max,genders,"
         "publisher_platforms,facebook_positions,instagram_positions}},"
-        "creative{title,body,image_url,thumbnail_url,image_hash,"
+        "creative{id,title,body,image_url,thumbnail_url,image_hash,"
         "asset_feed_spec{videos{video_id},images{url}},"
         "object_story_spec{"
         "text_data{message},"
@@ -113,7 +439,7 @@ def get_data_script():
     )
 
     def fetch_all_ads():
-        url = f"https://graph.facebook.com/{API_VERSION}/{AD_ACCOUNT_ID}/ads"
+        url = f"{BASE_URL}{AD_ACCOUNT_ID}/ads"
         params = {
             'access_token': ACCESS_TOKEN,
             'fields': FIELDS,
@@ -122,34 +448,40 @@ def get_data_script():
         }
 
         ads, hashes, vids = [], set(), set()
+        # One creative often backs many ad variants; scan each creative id once
+        scanned = {}
         print("Fetching ads...")
-        page = 1
-        while url:
-            res = requests.get(url, params=params if page == 1 else {})
-            res.raise_for_status()
-            data = res.json()
-            for ad in data.get("data", []):
-                creative = ad.get("creative", {})
-                ad["format_category"] = determine_format_category(creative)
-
-                # Collect image hashes
-                if safe_get(creative, "image_hash"):
-                    hashes.add(creative["image_hash"])
-                for att in safe_get(creative, "object_story_spec.link_data.child_attachments", []):
-                    if "image_hash" in att:
-                        hashes.add(att["image_hash"])
-
-                # Collect video IDs
-                for vid in safe_get(creative, "asset_feed_spec.videos", []):
-                    if "video_id" in vid:
-                        vids.add(vid["video_id"])
-                if safe_get(creative, "object_story_spec.video_data.video_id"):
-                    vids.add(creative["object_story_spec"]["video_data"]["video_id"])
-                ads.append(ad)
-
-            print(f"Fetched page {page} ({len(data.get('data', []))} ads)")
-            url = data.get("paging", {}).get("next")
-            page += 1
+
+        def get_page(page_url, page_params=None):
+            res = _graph_request('GET', page_url, params=page_params)
+            return orjson.loads(res.content)
+
+        # The next page is requested while the current one is processed
+        # (Graph cursors only allow one page in flight)
+        with ThreadPoolExecutor(max_workers=1) as prefetch:
+            page = 1
+            data = get_page(url, params)
+            while data is not None:
+                next_url = data.get("paging", {}).get("next")
+                next_page = prefetch.submit(get_page, next_url) if next_url else None
+                for ad in data.get("data", []):
+                    # Classify and collect image hashes / video IDs in one walk
+                    creative = ad.get("creative", {})
+                    creative_id = creative.get("id")
+                    if creative_id in scanned:
+                        ad["format_category"] = scanned[creative_id]
+                    else:
+                        category, ad_hashes, ad_vids = _scan_creative(creative)
+                        if creative_id:
+                            scanned[creative_id] = category
+                        ad["format_category"] = category
+                        hashes.update(ad_hashes)
+                        vids.update(ad_vids)
+                    ads.append(ad)
+
+                print(f"Fetched page {page} ({len(data.get('data', []))} ads)")
+                data = next_page.result() if next_page else None
+                page += 1
         return ads, hashes, vids
 
     ads_data, unique_hashes, unique_video_ids = fetch_all_ads()
@@ -157,111 +489,57 @@ def get_data_script():
     # -------------------------------------------------------------
     # Step 2: Resolve media URLs
     # -------------------------------------------------------------
-    hash_url_map = fetch_image_urls(unique_hashes, ACCESS_TOKEN, AD_ACCOUNT_ID, API_VERSION)
-    video_url_map = fetch_video_urls(unique_video_ids, ACCESS_TOKEN, API_VERSION)
+    # Image and video resolution are independent, so run them side by side
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        images = executor.submit(fetch_image_urls, unique_hashes, ACCESS_TOKEN, AD_ACCOUNT_ID)
+        videos = executor.submit(fetch_video_urls, unique_video_ids, ACCESS_TOKEN)
+        hash_url_map, video_url_map = images.result(), videos.result()
 
     for ad in ads_data:
         creative = ad.get("creative", {})
-        top_hash = safe_get(creative, "image_hash")
+        top_hash = creative.get("image_hash")
         if top_hash in hash_url_map:
             creative["image_url"] = hash_url_map[top_hash]
 
-        for v in safe_get(creative, "asset_feed_spec.videos", []):
+        for v in _get_asset_videos(creative, []):
             vid = v.get("video_id")
             if vid in video_url_map:
                 v["source_url"] = video_url_map[vid]
 
-        video_data = safe_get(creative, "object_story_spec.video_data")
+        video_data = _get_story_video_data(creative)
         if video_data and "video_id" in video_data:
             vid = video_data["video_id"]
             if vid in video_url_map:
                 video_data["video_url"] = video_url_map[vid]
 
     # -------------------------------------------------------------
-    # Step 3: Save raw JSON locally
+    # Step 3 & 4: Save raw JSON and flattened CSV (to S3 when configured)
     # -------------------------------------------------------------
+    bucket_name = os.getenv("AWS_S3_BUCKET_NAME")
+    if bucket_name:
+        # Stream each output through a bounded spool into a multipart upload; no local copies
+        s3 = get_s3_client()
+
+        # ingest.py detects the gzip header and decompresses while parsing
+        upload_stream(s3, bucket_name, S3_JSON_KEY, "application/json",
+                      lambda f: write_dataset_json(ads_data, f), compress=True)
+        print(f"✅ Uploaded raw dataset to s3://{bucket_name}/{S3_JSON_KEY}")
+
+        rows = upload_stream(s3, bucket_name, S3_CSV_KEY, "text/csv",
+                             lambda f: write_ads_csv_bytes(ads_data, f))
+        print(f"✅ Exported {rows} ads to s3://{bucket_name}/{S3_CSV_KEY}")
+        return
+
     os.makedirs("data", exist_ok=True)
     json_path = "data/dataset.json"
-    with open(json_path, "w", encoding="utf-8") as f:
-        json.dump(ads_data, f, indent=2, ensure_ascii=False)
+    with open(json_path, "wb") as f:
+        write_dataset_json(ads_data, f)
     print(f"✅ Saved raw dataset to {json_path}")
 
-    # -------------------------------------------------------------
-    # Step 4: Flatten into CSV
-    # -------------------------------------------------------------
-    records = []
-    for ad in ads_data:
-        campaign = ad.get("campaign", {})
-        adset = ad.get("adset", {})
-        creative = ad.get("creative", {})
-
-        # ✅ Unwrap nested insights
-        ins_data = None
-        if isinstance(ad.get("insights"), dict):
-            ins_list = ad["insights"].get("data", [])
-            if isinstance(ins_list, list) and len(ins_list) > 0:
-                ins_data = ins_list[0]
-        ins = ins_data or {}
-
-        # ✅ Extract metrics safely
-        spend = float(ins.get("spend", 0))
-        impressions = int(ins.get("impressions", 0))
-        clicks = int(ins.get("clicks", 0))
-        ctr = float(ins.get("ctr", 0))
-        cpc = float(ins.get("cpc", 0))
-        cpm = float(ins.get("cpm", 0))
-
-        # Handle purchase_roas (list or dict)
-        roas_val = 0
-        roas_field = ins.get("purchase_roas")
-        if isinstance(roas_field, list) and len(roas_field) > 0:
-            val = roas_field[0].get("value")
-            if val:
-                roas_val = float(val)
-
-        # Derive conversions and conversion rate
-        actions = ins.get("actions", [])
-        conversions = sum(int(a.get("value", 0)) for a in actions if a.get("action_type") in ["offsite_conversion", "purchase"])
-        conversion_rate = (conversions / clicks * 100) if clicks > 0 else 0
-
-        rec = {
-            "ad_id": ad.get("id"),
-            "ad_name": ad.get("name"),
-            "ad_status": ad.get("status"),
-            "format_category": ad.get("format_category"),
-
-            "campaign_id": campaign.get("id"),
-            "campaign_name": campaign.get("name"),
-            "campaign_objective": campaign.get("objective"),
-
-            "adset_id": adset.get("id"),
-            "adset_name": adset.get("name"),
-            "optimization_goal": adset.get("optimization_goal"),
-
-            "creative_title": creative.get("title"),
-            "creative_body": creative.get("body"),
-            "creative_image_url": creative.get("image_url"),
-            "creative_thumbnail_url": creative.get("thumbnail_url"),
-
-            "copy_text": safe_get(creative, "object_story_spec.text_data.message"),
-            "link_url": safe_get(creative, "object_story_spec.link_data.link"),
-
-            "spend": spend,
-            "impressions": impressions,
-            "clicks": clicks,
-            "ctr": ctr,
-            "cpc": cpc,
-            "cpm": cpm,
-            "roas": roas_val,
-            "conversions": conversions,
-            "conversion_rate": conversion_rate,
-        }
-        records.append(rec)
-
-    df = pd.DataFrame(records)
     csv_path = "data/meta_ads_data.csv"
-    df.to_csv(csv_path, index=False, encoding="utf-8-sig")
-    print(f"✅ Exported {len(df)} ads to {csv_path}")
+    with open(csv_path, "w", newline="", encoding="utf-8-sig") as f:
+        rows = write_ads_csv(ads_data, f)
+    print(f"✅ Exported {rows} ads to {csv_path}")
 
 # -------------------------------------------------------------------
 if __name__ == "__main__":
@@ -1,14 +1,30 @@
 import os
-import json
+import math
+import functools
+import orjson
+import gzip
 import time
+import shelve
+import sqlite3
+import hashlib
+from array import array
+from dataclasses import dataclass
 import boto3
+from boto3.s3.transfer import TransferConfig
 import yaml
+import ijson
 from io import BytesIO
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 from tqdm import tqdm
+from tenacity import retry, stop_after_attempt, wait_exponential_jitter
 from openai import OpenAI
-from pinecone import Pinecone
+import grpc
+from pinecone.grpc import PineconeGRPC
+from pinecone.exceptions import NotFoundException
 from langchain_openai import OpenAIEmbeddings
+from src import sqlite_vec_store
 
 # Load .env
 load_dotenv()
@@ -25,60 +41,137 @@ def load_config():
 config = load_config()
 INDEX_NAME = os.getenv("PINECONE_INDEX_NAME", config["pinecone"]["index_name"])
 EMBEDDING_MODEL = config["embedding_model"]["model_name"]
+EMBEDDING_DIMENSIONS = int(config["embedding_model"].get("dimensions", 1536))
+EMBED_BATCH = 512  # texts per OpenAI embeddings request
+# Vectors are stored unit-length, so a dotproduct index ranks exactly like cosine without the per-distance norms
+INDEX_METRIC = config["pinecone"].get("metric", "dotproduct")
+# Concurrent upsert requests; kept modest to stay under Pinecone's rate limits
+PINECONE_POOL_THREADS = int(os.getenv("PINECONE_POOL_THREADS", 10))
+UPSERT_BATCH_SIZE = int(os.getenv("UPSERT_BATCH_SIZE", 50))
+# Pinecone rejects upsert requests over 2 MB; leave headroom for encoding overhead
+MAX_UPSERT_BYTES = int(os.getenv("MAX_UPSERT_BYTES", 1_500_000))
+# Keyed by dimensions too, so changing embedding size re-runs the dimension check below
+INDEX_SENTINEL = f"data/.pc_idx_{INDEX_NAME}_{EMBEDDING_DIMENSIONS}"
+INDEX_CHECK_TTL = 24 * 3600  # seconds
+# Embeddings are deterministic per model, so unchanged texts are reused across runs
+EMBED_CACHE_PATH = os.getenv("EMBED_CACHE_PATH", ".cache/embed_cache.db")
+# Concurrent caption requests; bounded to respect the OpenAI rate limit
+CAPTION_THREADS = int(os.getenv("CAPTION_THREADS", 10))
+CAPTION_CACHE_PATH = os.getenv("CAPTION_CACHE_PATH", ".cache/caption_cache")
+# Embedding and upserting overlap; these bound how much work (and memory) is queued at once
+EMBED_WORKERS = int(os.getenv("EMBED_WORKERS", 2))
+MAX_EMBEDS_IN_FLIGHT = 4
+MAX_UPSERTS_IN_FLIGHT = PINECONE_POOL_THREADS * 2
+# Local mode: vectors are also written to an on-disk sqlite-vec index the app can query without Pinecone
+VECTOR_STORE_CONFIG = config.get("vector_store", {})
+LOCAL_INDEX_PATH = (
+    VECTOR_STORE_CONFIG.get("sqlite_path", ".cache/vectors.db")
+    if VECTOR_STORE_CONFIG.get("backend") == "sqlite_vec" else None
+)
 
 # ============ CLIENT SETUP ============
-print("Initializing OpenAI, Pinecone, and AWS clients...")
-
-openai_client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-pinecone_client = Pinecone(api_key=os.getenv("PINECONE_API_KEY"))
-s3 = boto3.client(
-    "s3",
-    aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"),
-    aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY")
-)
+# Clients are created on first use, so importing this module has no network side effects
+
+@functools.cache
+def get_openai_client():
+    return OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+
+@functools.cache
+def get_pinecone_client():
+    # gRPC data plane: binary framing and HTTP/2 multiplexing make upserts cheaper than REST
+    return PineconeGRPC(api_key=os.getenv("PINECONE_API_KEY"))
+
+@functools.cache
+def get_s3_client():
+    return boto3.client(
+        "s3",
+        aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"),
+        aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY")
+    )
+
+@functools.cache
+def get_index():
+    return get_pinecone_client().Index(INDEX_NAME, pool_threads=PINECONE_POOL_THREADS)
+
+@functools.cache
+def get_embeddings():
+    return OpenAIEmbeddings(model=EMBEDDING_MODEL, dimensions=EMBEDDING_DIMENSIONS)
 
 bucket_name = os.getenv("AWS_S3_BUCKET_NAME")
 s3_key = os.getenv("S3_KEY", "data/dataset.json")
 local_data_path = "data/dataset.json"
+S3_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=16 * 1024 * 1024,
+    multipart_chunksize=8 * 1024 * 1024,
+    max_concurrency=8,
+)
+GZIP_MAGIC = b"\x1f\x8b"
+
+# ============ LOAD DATA + ENSURE INDEX ============
+# Only these top-level ad fields are used downstream; everything else is dropped while parsing
+DATASET_FIELDS = (
+    "id", "name", "primary_text", "headline", "description",
+    "call_to_action_type", "image_url", "video_url",
+    "format_category", "campaign",
+)
 
-# ============ LOAD DATA ============
-print("\nStep 1: Loading dataset...")
+def stream_ads(fileobj):
+    """Incrementally parses a JSON array of ads, keeping a slim projection of each."""
+    return [{k: ad[k] for k in DATASET_FIELDS if k in ad} for ad in ijson.items(fileobj, "item")]
 
 def load_dataset():
     # Try to load from S3, fallback to local
     try:
         print(f"Attempting to load from S3: {bucket_name}/{s3_key}")
-        response = s3.get_object(Bucket=bucket_name, Key=s3_key)
-        data = json.load(response["Body"])
+        # Large snapshots are fetched as parallel ranged GETs into memory
+        body = BytesIO()
+        get_s3_client().download_fileobj(bucket_name, s3_key, body, Config=S3_TRANSFER_CONFIG)
+        body.seek(0)
+        # Snapshots are uploaded gzip-compressed; boto3 does not decode Content-Encoding
+        if body.getbuffer()[:2] == GZIP_MAGIC:
+            body = gzip.GzipFile(fileobj=body)
+        data = stream_ads(body)
         print(f"✅ Loaded dataset from S3 ({len(data)} records)")
     except Exception as e:
         print(f"⚠️ S3 load failed ({e}). Falling back to local file.")
         if not os.path.exists(local_data_path):
             raise FileNotFoundError("No dataset found in S3 or local path.")
-        with open(local_data_path, "r") as f:
-            data = json.load(f)
+        with open(local_data_path, "rb") as f:
+            data = stream_ads(f)
         print(f"✅ Loaded dataset locally ({len(data)} records)")
     return data
 
-dataset = load_dataset()
-
-# ============ ENSURE INDEX EXISTS ============
-print("\nStep 2: Verifying Pinecone index...")
-
-if INDEX_NAME not in pinecone_client.list_indexes().names():
-    print(f"⚠️ Index '{INDEX_NAME}' not found. Creating new index...")
-    pinecone_client.create_index(
-        name=INDEX_NAME,
-        dimension=1536,  # text-embedding-3-small dimension
-        metric="cosine"
-    )
-else:
-    print(f"✅ Pinecone index '{INDEX_NAME}' found.")
-
-index = pinecone_client.Index(INDEX_NAME)
+def index_check_is_fresh():
+    try:
+        return time.time() - os.path.getmtime(INDEX_SENTINEL) < INDEX_CHECK_TTL
+    except OSError:
+        return False
 
-# ============ EMBEDDING FUNCTION ============
-embeddings = OpenAIEmbeddings(model=EMBEDDING_MODEL)
+def ensure_index(force=False):
+    # A recent successful check is remembered on disk, saving a control-plane round-trip per run
+    if not force and index_check_is_fresh():
+        print(f"✅ Pinecone index '{INDEX_NAME}' verified within the last 24h; skipping check.")
+        return
+    pinecone_client = get_pinecone_client()
+    if INDEX_NAME not in pinecone_client.list_indexes().names():
+        print(f"⚠️ Index '{INDEX_NAME}' not found. Creating new index...")
+        pinecone_client.create_index(
+            name=INDEX_NAME,
+            dimension=EMBEDDING_DIMENSIONS,
+            metric=INDEX_METRIC
+        )
+    else:
+        index_dimension = pinecone_client.describe_index(INDEX_NAME).dimension
+        if index_dimension != EMBEDDING_DIMENSIONS:
+            raise ValueError(
+                f"Pinecone index '{INDEX_NAME}' stores {index_dimension}-d vectors but "
+                f"embedding_model.dimensions is {EMBEDDING_DIMENSIONS}; use a new index name "
+                f"or set the dimensions back to {index_dimension}."
+            )
+        print(f"✅ Pinecone index '{INDEX_NAME}' found.")
+    os.makedirs(os.path.dirname(INDEX_SENTINEL), exist_ok=True)
+    with open(INDEX_SENTINEL, "w"):
+        pass
 
 # ============ IMAGE CAPTIONING (GPT-4o) ============
 def generate_caption(image_url):
@@ -88,7 +181,7 @@ def generate_caption(image_url):
     """
     try:
         prompt = f"Describe this marketing image in one short sentence (focus on emotion, color, and message): {image_url}"
-        response = openai_client.chat.completions.create(
+        response = get_openai_client().chat.completions.create(
             model="gpt-4o-mini",
             messages=[
                 {"role": "system", "content": "You are a creative advertising assistant."},
@@ -102,54 +195,268 @@ def generate_caption(image_url):
         return ""
 
 # ============ BUILD DOCUMENTS ============
-print("\nStep 3: Preparing documents for embedding...")
-
-documents = []
-for ad in tqdm(dataset, desc="Processing Ads"):
-    ad_text = (
-        f"Ad Name: {ad.get('name', '')}\n"
-        f"Primary Text: {ad.get('primary_text', '')}\n"
-        f"Headline: {ad.get('headline', '')}\n"
-        f"Description: {ad.get('description', '')}\n"
-        f"CTA: {ad.get('call_to_action_type', '')}\n"
-    )
+# Built once; each ad only supplies a field dict
+AD_TEMPLATE = (
+    "Ad Name: {name}\n"
+    "Primary Text: {primary_text}\n"
+    "Headline: {headline}\n"
+    "Description: {description}\n"
+    "CTA: {call_to_action_type}\n"
+    "\nImage Summary: {caption}"
+)
+AD_TEMPLATE_FIELDS = ("name", "primary_text", "headline", "description", "call_to_action_type")
 
-    # Optional image caption
-    image_caption = ""
-    if ad.get("image_url"):
-        image_caption = generate_caption(ad["image_url"])
+def caption_key(image_url):
+    return hashlib.sha256(image_url.encode("utf-8")).hexdigest()
 
-    combined_text = f"{ad_text}\nImage Summary: {image_caption}"
+def caption_images(dataset):
+    """
+    Captions each distinct image once, concurrently; ads often share creatives, and
+    captions from earlier runs are reused from the on-disk cache. Returns {url: caption}.
+    """
+    image_urls = list(dict.fromkeys(ad["image_url"] for ad in dataset if ad.get("image_url")))
+    os.makedirs(os.path.dirname(CAPTION_CACHE_PATH) or ".", exist_ok=True)
+    with shelve.open(CAPTION_CACHE_PATH) as caption_cache:
+        captions = {url: caption_cache[caption_key(url)] for url in image_urls if caption_key(url) in caption_cache}
+        to_caption = [url for url in image_urls if url not in captions]
+        print(f"♻️ {len(captions)}/{len(image_urls)} image captions served from the caption cache.")
+        with ThreadPoolExecutor(max_workers=CAPTION_THREADS) as executor:
+            results = executor.map(generate_caption, to_caption)
+            for url, caption in tqdm(zip(to_caption, results), total=len(to_caption), desc="Captioning Images"):
+                captions[url] = caption
+                if caption:  # failures return "" and are retried next run
+                    caption_cache[caption_key(url)] = caption
+    return captions
 
-    documents.append({
-        "id": ad.get("id", str(time.time())),
-        "text": combined_text,
-        "metadata": {
-            "ad_id": ad.get("id", ""),
-            "ad_name": ad.get("name", ""),
-            "image_url": ad.get("image_url", ""),
-            "video_url": ad.get("video_url", ""),
-            "caption": image_caption
-        }
-    })
+@dataclass(slots=True)
+class AdDocument:
+    """One ad ready for embedding; slots keep per-document overhead below a dict's."""
+    id: str
+    text: str
+    metadata: dict
 
-print(f"✅ Prepared {len(documents)} documents for embedding.")
+def build_documents(dataset, captions):
+    documents = []
+    for ad in tqdm(dataset, desc="Processing Ads"):
+        fields = {key: ad.get(key, "") for key in AD_TEMPLATE_FIELDS}
+
+        # Optional image caption
+        image_caption = captions.get(ad.get("image_url"), "")
+        fields["caption"] = image_caption
+
+        combined_text = AD_TEMPLATE.format_map(fields)
+
+        documents.append(AdDocument(
+            id=ad.get("id", str(time.time())),
+            text=combined_text,
+            metadata={
+                "ad_id": ad.get("id", ""),
+                "ad_name": ad.get("name", ""),
+                "image_url": ad.get("image_url", ""),
+                "video_url": ad.get("video_url", ""),
+                "caption": image_caption,
+                # Filterable fields for server-side Pinecone metadata filters
+                "format_category": ad.get("format_category") or "",
+                "campaign_objective": (ad.get("campaign") or {}).get("objective") or "",
+            },
+        ))
+    return documents
 
 # ============ EMBEDDING + UPSERT ============
-print("\nStep 4: Generating embeddings and upserting to Pinecone...")
+def open_embed_cache(path=EMBED_CACHE_PATH):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE IF NOT EXISTS embeddings (hash BLOB PRIMARY KEY, vec BLOB)")
+    return conn
+
+def text_hash(text):
+    # Model and dimensions are part of the key so changing either never serves stale vectors
+    key = f"{EMBEDDING_MODEL}:{EMBEDDING_DIMENSIONS}\0{text}"
+    return hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+
+def cached_vectors(conn, hashes):
+    """Returns {hash: float32 vector} for the hashes already present in the cache."""
+    found = {}
+    hashes = list(hashes)
+    for i in range(0, len(hashes), 500):  # stay under SQLite's bound-parameter limit
+        chunk = hashes[i:i + 500]
+        rows = conn.execute(
+            f"SELECT hash, vec FROM embeddings WHERE hash IN ({','.join('?' * len(chunk))})", chunk
+        )
+        for h, blob in rows:
+            found[h] = array("f", blob)
+    return found
 
-batch_size = 50
-for i in range(0, len(documents), batch_size):
-    batch = documents[i:i + batch_size]
-    texts = [doc["text"] for doc in batch]
-    metadatas = [doc["metadata"] for doc in batch]
-    ids = [doc["id"] for doc in batch]
+def normalize(vector):
+    """Scales a vector to unit length (float32), so dot product equals cosine similarity."""
+    norm = math.sqrt(math.fsum(x * x for x in vector))
+    return array("f", (x / norm for x in vector) if norm else vector)
 
+def estimate_record_bytes(record):
+    """Rough request size of one (id, vector, metadata) upsert record."""
+    vec_id, vector, metadata = record
+    # orjson returns UTF-8 bytes, so the length is the real encoded size
+    return len(vec_id) + 4 * len(vector) + len(orjson.dumps(metadata))
+
+def upsert_batches(records):
+    """Yields record lists capped by UPSERT_BATCH_SIZE and by MAX_UPSERT_BYTES."""
+    batch, batch_bytes = [], 0
+    for record in records:
+        size = estimate_record_bytes(record)
+        if batch and (len(batch) == UPSERT_BATCH_SIZE or batch_bytes + size > MAX_UPSERT_BYTES):
+            yield batch
+            batch, batch_bytes = [], 0
+        batch.append(record)
+        batch_bytes += size
+    if batch:
+        yield batch
+
+@retry(stop=stop_after_attempt(4), wait=wait_exponential_jitter(1, 30), reraise=True)
+def upsert_with_retry(batch):
+    """Synchronous re-upsert of a failed batch, with jittered exponential backoff."""
+    get_index().upsert(vectors=batch)
+
+def is_index_missing(error) -> bool:
+    """
+    True if an upsert error means the index does not exist: NotFoundException / HTTP 404
+    from REST, or NOT_FOUND from gRPC (also when wrapped by the SDK as the cause).
+    """
+    while error is not None:
+        if isinstance(error, NotFoundException) or getattr(error, "status", None) == 404:
+            return True
+        if isinstance(error, grpc.RpcError) and callable(getattr(error, "code", None)) \
+                and error.code() == grpc.StatusCode.NOT_FOUND:
+            return True
+        error = error.__cause__
+    return False
+
+def collect_upsert(batch_num, batch, result):
     try:
-        vectors = embeddings.embed_documents(texts)
-        index.upsert(vectors=zip(ids, vectors, metadatas))
+        result.result()
     except Exception as e:
-        print(f"⚠️ Batch {i // batch_size + 1} failed: {e}")
+        # The cached index check may be stale (index deleted since); re-verify before retrying
+        if is_index_missing(e):
+            if os.path.exists(INDEX_SENTINEL):
+                os.remove(INDEX_SENTINEL)
+            ensure_index(force=True)
+        try:
+            upsert_with_retry(batch)
+        except Exception as e:
+            print(f"⚠️ Batch {batch_num} failed: {e}")
+
+def write_local_index(documents, hashes, vector_by_hash):
+    """Mirrors the embedded documents into the local sqlite-vec index."""
+    try:
+        conn = sqlite_vec_store.connect(LOCAL_INDEX_PATH, EMBEDDING_DIMENSIONS)
+    except RuntimeError as e:
+        print(f"⚠️ Skipping local sqlite-vec index: {e}")
+        return
+    with conn:
+        sqlite_vec_store.upsert_records(conn, (
+            (doc.id, vector_by_hash[h], doc.text, doc.metadata)
+            for doc, h in zip(documents, hashes)
+            if h in vector_by_hash  # documents whose embedding batch failed are left out
+        ))
+    conn.close()
+    print(f"💾 Local sqlite-vec index written to {LOCAL_INDEX_PATH}.")
+
+def embed_and_upsert(documents):
+    """
+    Embeds each unique document text once (reusing cached vectors) and upserts as
+    batches become ready, so batch N uploads while batch N+1 is being embedded.
+    """
+    index = get_index()
+    embeddings = get_embeddings()
+
+    # Identical creative text is common across ad variants, so embed each unique text once
+    hashes = [text_hash(doc.text) for doc in documents]
+    unique = {h: doc.text for h, doc in zip(hashes, documents)}
+    docs_by_hash = {}
+    for doc, h in zip(documents, hashes):
+        docs_by_hash.setdefault(h, []).append(doc)
+
+    embed_cache = open_embed_cache()
+    vector_by_hash = cached_vectors(embed_cache, unique)
+    missing = [(h, text) for h, text in unique.items() if h not in vector_by_hash]
+    print(f"♻️ {len(unique) - len(missing)}/{len(unique)} unique texts served from the embedding cache.")
+
+    pending_upserts = deque()
+    upsert_count = 0
+
+    def records_for(batch_hashes):
+        # Vectors are only unpacked to lists here, one batch at a time
+        for h in batch_hashes:
+            values = vector_by_hash[h].tolist()
+            for doc in docs_by_hash[h]:
+                yield (doc.id, values, doc.metadata)
+
+    def submit_upserts(records):
+        """Queues upserts on the client's thread pool, waiting on the oldest once too many are in flight."""
+        nonlocal upsert_count
+        for batch in upsert_batches(records):
+            upsert_count += 1
+            pending_upserts.append((upsert_count, batch, index.upsert(vectors=batch, async_req=True)))
+            if len(pending_upserts) > MAX_UPSERTS_IN_FLIGHT:
+                collect_upsert(*pending_upserts.popleft())
+
+    def finish_embed_batch(batch_num, batch, future):
+        """Caches a completed embedding batch and hands its records straight to the upserter."""
+        try:
+            batch_vectors = future.result()
+        except Exception as e:
+            print(f"⚠️ Embedding batch {batch_num} failed: {e}")
+            return
+        # Keep vectors as packed float32 (~4x smaller than a list of Python floats)
+        packed = [(h, normalize(vector)) for (h, _), vector in zip(batch, batch_vectors)]
+        vector_by_hash.update(packed)
+        embed_cache.executemany(
+            "INSERT OR REPLACE INTO embeddings (hash, vec) VALUES (?, ?)",
+            [(h, vector.tobytes()) for h, vector in packed],
+        )
+        embed_cache.commit()
+        submit_upserts(records_for([h for h, _ in packed]))
+
+    # Cached vectors can be upserted right away, while the misses are still being embedded
+    submit_upserts(records_for(list(vector_by_hash)))
+
+    # Embed the misses in large batches (few HTTP round-trips) on a small pool; a failed batch is left out
+    embed_batches = [missing[i:i + EMBED_BATCH] for i in range(0, len(missing), EMBED_BATCH)]
+    in_flight = deque()
+    with ThreadPoolExecutor(max_workers=EMBED_WORKERS) as embed_pool:
+        for batch_num, batch in enumerate(embed_batches, start=1):
+            batch_texts = [text for _, text in batch]
+            in_flight.append((batch_num, batch, embed_pool.submit(embeddings.embed_documents, batch_texts)))
+            if len(in_flight) >= MAX_EMBEDS_IN_FLIGHT:
+                finish_embed_batch(*in_flight.popleft())
+        while in_flight:
+            finish_embed_batch(*in_flight.popleft())
+    embed_cache.close()
+
+    if LOCAL_INDEX_PATH:
+        write_local_index(documents, hashes, vector_by_hash)
+
+    while pending_upserts:
+        collect_upsert(*pending_upserts.popleft())
+
+# ============ MAIN ============
+def main():
+    # The S3 download and the Pinecone control-plane calls are independent, so run them together
+    print("\nSteps 1-2: Loading dataset and verifying Pinecone index...")
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        index_ready = executor.submit(ensure_index)
+        dataset = load_dataset()
+        index_ready.result()
+
+    print("\nStep 3: Preparing documents for embedding...")
+    captions = caption_images(dataset)
+    documents = build_documents(dataset, captions)
+    print(f"✅ Prepared {len(documents)} documents for embedding.")
+
+    print("\nStep 4: Generating embeddings and upserting to Pinecone...")
+    embed_and_upsert(documents)
+
+    print("✅ Ingestion complete.")
+    print(f"💾 Pinecone index '{INDEX_NAME}' now contains {len(documents)} vectors.")
 
-print("✅ Ingestion complete.")
-print(f"💾 Pinecone index '{INDEX_NAME}' now contains {len(documents)} vectors.")
+if __name__ == "__main__":
+    main()
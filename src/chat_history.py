@@ -0,0 +1,116 @@
+import logging
+import threading
+from langchain_core.chat_history import BaseChatMessageHistory
+from langchain_core.messages import BaseMessage, SystemMessage
+from langchain_openai import ChatOpenAI
+from src.utils import get_http_client
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_PROMPT = (
+    "Summarize the conversation below between a marketing analyst and an AI assistant "
+    "about Facebook ad performance. Keep every figure, campaign or ad name, filter and "
+    "decision that later questions may refer to. Be concise.\n\n"
+    "{previous}{transcript}"
+)
+
+def estimate_tokens(messages) -> int:
+    """Cheap token estimate (~4 characters per token); only used to decide when to compact."""
+    return sum(len(str(m.content)) for m in messages) // 4
+
+class CompactingChatMessageHistory(BaseChatMessageHistory):
+    """
+    Prompt-side view of a chat history that stays within a token budget.
+
+    When the messages exceed `max_tokens`, the oldest ones are replaced by a
+    single summary SystemMessage (written by a small model) and only the recent
+    turns are passed through verbatim. The summary is reused until the recent
+    part outgrows the budget again, so the prompt prefix stays stable between
+    compactions. Writes go straight to `base`, which keeps the full transcript
+    for display and saving.
+
+    Reading `messages` never calls the model; summarizing happens in compact(),
+    which runs after each turn is written.
+    """
+    def __init__(self, base: BaseChatMessageHistory, max_tokens: int = 6000, summarizer_model: str = "gpt-4o-mini"):
+        self.base = base
+        self.max_tokens = max_tokens
+        self._summarizer = ChatOpenAI(model=summarizer_model, temperature=0, http_client=get_http_client())
+        self._summary = ""
+        self._summarized = 0  # number of leading base messages covered by the summary
+        self._boundary = None  # last summarized message, to detect the base list being replaced
+        self._lock = threading.Lock()
+
+    def _check_base(self, messages):
+        """Drops the summary if the base history was replaced or extended at the front."""
+        if self._summarized and (
+            self._summarized > len(messages) or messages[self._summarized - 1] is not self._boundary
+        ):
+            self._summary, self._summarized, self._boundary = "", 0, None
+
+    @property
+    def messages(self) -> list[BaseMessage]:
+        with self._lock:
+            messages = self.base.messages
+            self._check_base(messages)
+            recent = messages[self._summarized:]
+            summary = self._summary
+        if not summary:
+            return list(recent)
+        return [SystemMessage(content=f"Conversation summary: {summary}"), *recent]
+
+    def compact(self) -> None:
+        """
+        Folds the oldest turns into the summary once the recent ones exceed the budget.
+        Makes one LLM call when it does; the lock is not held during it.
+        """
+        with self._lock:
+            messages = self.base.messages
+            self._check_base(messages)
+            recent = messages[self._summarized:]
+            if estimate_tokens(recent) <= self.max_tokens:
+                return
+            split = self._split_point(recent)
+            previous, start = self._summary, self._summarized
+        summary = self._summarize(previous, recent[:split])
+        if summary is None:
+            return
+        with self._lock:
+            if (self._summary, self._summarized) != (previous, start):
+                return  # a concurrent compaction already moved on
+            self._summary = summary
+            self._summarized = start + split
+            self._boundary = recent[split - 1]
+
+    def _split_point(self, messages) -> int:
+        """Index where the kept tail (about half the budget, whole turns) begins."""
+        budget = self.max_tokens // 2
+        kept = 0
+        split = len(messages)
+        while split > 0 and kept + estimate_tokens(messages[split - 1:split]) <= budget:
+            split -= 1
+            kept += estimate_tokens(messages[split:split + 1])
+        # Start the kept tail on a user message so no answer loses its question
+        while split < len(messages) and messages[split].type != "human":
+            split += 1
+        return max(split, 1)
+
+    def _summarize(self, summary: str, messages) -> str | None:
+        transcript = "\n".join(f"{m.type}: {m.content}" for m in messages)
+        previous = f"Earlier summary: {summary}\n\n" if summary else ""
+        try:
+            return self._summarizer.invoke(SUMMARY_PROMPT.format(previous=previous, transcript=transcript)).content
+        except Exception as e:
+            # Better an oversized prompt than a failed turn; retried after the next turn
+            logger.warning("Could not summarize chat history: %s", e)
+            return None
+
+    def add_messages(self, messages) -> None:
+        self.base.add_messages(messages)
+        # The turn is complete (its answer already shown), so this is the time to summarize
+        self.compact()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._summary, self._summarized, self._boundary = "", 0, None
+        self.base.clear()
@@ -1,71 +1,153 @@
-import yaml
+import functools
+from operator import itemgetter
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-from langchain_core.runnables import RunnablePassthrough
+from langchain_core.runnables import RunnableBranch, RunnableLambda, RunnablePassthrough
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.runnables.history import RunnableWithMessageHistory
 from langchain_openai import ChatOpenAI
-from src.vectorstore import VectorDB
+from src.vectorstore import get_vector_db
+from src.utils import load_config, get_http_client
+from src.semantic_cache import SemanticCache
+from src.chat_history import CompactingChatMessageHistory
 
-import yaml
+# Returned without calling the LLM when retrieval finds nothing relevant
+NO_CONTEXT_ANSWER = "The provided data does not contain enough information to answer this question."
+
+# Static prompts are built once at import rather than for every chain
+CONTEXTUALIZE_Q_PROMPT = ChatPromptTemplate.from_messages([
+    ("system",
+     "Given a chat history and the latest user question "
+     "which might reference context in the chat history, "
+     "formulate a standalone question which can be understood "
+     "without the chat history. Do NOT answer the question, "
+     "just reformulate it if needed and otherwise return it as is."),
+    MessagesPlaceholder(variable_name="chat_history"),
+    ("human", "{input}"),
+])
+
+EXPAND_Q_PROMPT = ChatPromptTemplate.from_messages([
+    ("system",
+     "Given a chat history and the latest user question, write {n} different "
+     "standalone search queries that could retrieve documents answering it. "
+     "Return one query per line with no numbering."),
+    MessagesPlaceholder(variable_name="chat_history"),
+    ("human", "{input}"),
+])
+
+@functools.lru_cache(maxsize=8)
+def qa_prompt_for(*system_prompts: str) -> ChatPromptTemplate:
+    """
+    Returns the answer prompt for the given system prompts (from config/prompts.yaml),
+    built once per distinct set of prompts.
+
+    Ordered static -> growing -> per-turn so OpenAI's prefix cache can reuse the
+    system prompts and earlier history; the retrieved context changes every turn,
+    so it comes after the history rather than inside the system prompt.
+    """
+    return ChatPromptTemplate.from_messages([
+        *[("system", prompt) for prompt in system_prompts],
+        MessagesPlaceholder(variable_name="chat_history"),
+        ("system", "Context:\n{context}"),
+        ("human", "{input}"),
+    ])
 
 class RAGChain:
     """
     Encapsulates the complete RAG logic, from retrieval to generation.
     """
-    def __init__(self, chat_memory_history):
+    def __init__(self, chat_memory_history, filters: dict | None = None):
         """
         Initializes the RAG chain with all necessary components.
         
         Args:
             chat_memory_history: A LangChain chat message history object.
+            filters (dict, optional): Sidebar filter values used to narrow retrieval.
         """
-        # 1. Load configuration
-        with open("config/config.yaml", 'r') as f:
-            config = yaml.safe_load(f)
+        # 1. Load configuration (cached across reruns, see src/utils.load_config)
+        config = load_config("config/config.yaml")
 
         ## Load prompts config
-        with open("config/prompts.yaml", 'r') as f:
-            prompts_config = yaml.safe_load(f)
+        prompts_config = load_config("config/prompts.yaml")
 
         # 2. Initialize components
-        vector_db = VectorDB()
-        self.retriever = vector_db.as_retriever()
+        self.vector_db = get_vector_db()
+        self.retriever = self.vector_db.as_retriever()
+        self.embedding_model = self.vector_db.embedding_model
         self.chat_memory = chat_memory_history
+        # Long conversations reach the prompt as a summary plus the recent turns
+        history_config = config.get('chat_history', {})
+        self.prompt_history = CompactingChatMessageHistory(
+            chat_memory_history,
+            max_tokens=history_config.get('max_tokens', 6000),
+            summarizer_model=history_config.get('summarizer_model', 'gpt-4o-mini'),
+        )
+        # Read at query time, so callers may update it between turns
+        self.filters = filters
+
+        # Near-duplicate questions reuse an earlier answer instead of re-running the chain
+        cache_config = config.get('semantic_cache', {})
+        self.response_cache = SemanticCache(
+            threshold=cache_config.get('threshold', 0.95),
+            ttl=cache_config.get('ttl_seconds', 300),
+            max_entries=cache_config.get('max_entries', 256),
+        )
         
         llm = ChatOpenAI(
             model=config['llm']['model_name'],
-            temperature=config['llm']['temperature']
+            temperature=config['llm']['temperature'],
+            # Routes requests sharing the static prompt prefix to the same prompt cache
+            model_kwargs={"prompt_cache_key": config['llm'].get('prompt_cache_key', 'facebook_ads_rag_v1')},
+            http_client=get_http_client(),
         )
 
+        # Deterministic LLM for query rewriting; the sub-chain is built once and reused
+        self._contextualize_llm = ChatOpenAI(temperature=0, http_client=get_http_client())
+        self._contextualize_chain = self._build_contextualize_chain()
+
         # 3. Define the prompt template
-        # This prompt uses the system message from config and structures the inputs.
-        qa_prompt = ChatPromptTemplate.from_messages([
-            #("system", config['llm']['system_prompt']),
-            ("system", prompts_config['rag_analyst_prompt']),
-            ("system", prompts_config['copywriting_generator_prompt']),
-            MessagesPlaceholder(variable_name="chat_history"),
-            ("human", "{input}"),
-        ])
+        qa_prompt = qa_prompt_for(
+            #config['llm']['system_prompt'],
+            prompts_config['rag_analyst_prompt'],
+            prompts_config['copywriting_generator_prompt'],
+        )
 
         # 4. Construct the main RAG chain
-        rag_chain_from_docs = (
+        rag_chain_from_docs = RunnableBranch(
+            # Nothing retrieved: answer directly instead of paying for an LLM call on empty context
+            (lambda x: not x["context"], lambda x: NO_CONTEXT_ANSWER),
             RunnablePassthrough.assign(
                 context=(lambda x: self.format_docs(x["context"]))
             )
             | qa_prompt
             | llm
-            | StrOutputParser()
+            | StrOutputParser(),
         )
         
+        query_variants = config.get('retrieval', {}).get('query_variants', 1)
+        if query_variants > 1:
+            # Multi-query expansion: the rephrasings are searched together in one batch
+            retrieve = self.expanded_queries(query_variants) | RunnableLambda(self._batch_retrieve)
+        else:
+            # A first-turn question is already standalone, so it skips the rephrase LLM call
+            retrieve = RunnableBranch(
+                (lambda x: not x["chat_history"], itemgetter("input")),
+                self.contextualized_question,
+            ) | RunnableLambda(self._retrieve)
+
         self.chain_with_history = RunnableWithMessageHistory(
             RunnablePassthrough.assign(
-                context=self.contextualized_question | self.retriever
+                context=retrieve
             ) | rag_chain_from_docs,
-            lambda session_id: self.chat_memory,
+            self._history_for_session,
             input_messages_key="input",
             history_messages_key="chat_history",
         )
 
+    def _history_for_session(self, session_id):
+        # app.py swaps chat_memory on every rerun; keep the compacting view pointed at the current one
+        self.prompt_history.base = self.chat_memory
+        return self.prompt_history
+
     @staticmethod
     def format_docs(docs):
         """Helper function to format retrieved documents into a single string."""
@@ -74,30 +156,121 @@ class RAGChain:
     @property
     def contextualized_question(self):
         """
-        Creates a sub-chain to rephrase a follow-up question into a standalone question
+        Sub-chain that rephrases a follow-up question into a standalone question
         using the conversation history.
         """
-        contextualize_q_system_prompt = (
-            "Given a chat history and the latest user question "
-            "which might reference context in the chat history, "
-            "formulate a standalone question which can be understood "
-            "without the chat history. Do NOT answer the question, "
-            "just reformulate it if needed and otherwise return it as is."
+        return self._contextualize_chain
+
+    def _build_contextualize_chain(self):
+        """Creates the contextualize sub-chain returned by `contextualized_question`."""
+        return CONTEXTUALIZE_Q_PROMPT | self._contextualize_llm | StrOutputParser()
+
+    def expanded_queries(self, n: int):
+        """
+        Creates a sub-chain that turns the user's question into a list of `n` search
+        queries: the original question plus standalone rephrasings from the LLM.
+        """
+        expand_q_prompt = EXPAND_Q_PROMPT.partial(n=str(n - 1))
+        variants = expand_q_prompt | self._contextualize_llm | StrOutputParser()
+        return RunnablePassthrough.assign(variants=variants) | (
+            lambda x: [x["input"], *[q.strip() for q in x["variants"].splitlines() if q.strip()][:n - 1]]
+        )
+
+    def _retrieve(self, query: str):
+        """Retrieves documents for one query, applying the current sidebar filters."""
+        if not self.filters:
+            return self.retriever.invoke(query)
+        return self.vector_db.as_retriever(filters=self.filters).invoke(query)
+
+    def _batch_retrieve(self, queries: list[str]):
+        """Searches all queries in one batch and merges the results, dropping duplicates."""
+        seen = set()
+        merged = []
+        for docs in self.vector_db.batch_retrieve(queries, filters=self.filters):
+            for doc in docs:
+                if doc.page_content not in seen:
+                    seen.add(doc.page_content)
+                    merged.append(doc)
+        return merged
+
+    def _cache_namespace(self) -> tuple:
+        """
+        Semantic cache partition: answers are only reused under the same filters
+        (output language included) and, so follow-ups like "tell me more" don't
+        collide across topics, after the same previous question.
+        """
+        previous = next(
+            (m.content for m in reversed(self.chat_memory.messages) if m.type == "human"), ""
         )
-        contextualize_q_prompt = ChatPromptTemplate.from_messages([
-            ("system", contextualize_q_system_prompt),
-            MessagesPlaceholder(variable_name="chat_history"),
-            ("human", "{input}"),
-        ])
-        contextualize_q_llm = ChatOpenAI(temperature=0)
-        return contextualize_q_prompt | contextualize_q_llm | StrOutputParser()
-
-    def run(self, user_input: str):
+        return tuple(sorted((self.filters or {}).items())), previous
+
+    def _record_cached_turn(self, user_input: str, response: str):
+        # The chain normally writes history itself; a cache hit bypasses it
+        self.chat_memory.add_user_message(user_input)
+        self.chat_memory.add_ai_message(response)
+
+    def run(self, user_input: str, question: str | None = None):
         """
         Invokes the RAG chain with the user's input and manages history.
+
+        `question` is the user's own wording, without any prompt preamble; it is what
+        the semantic cache embeds (defaults to `user_input`).
         """
+        namespace = self._cache_namespace()
+        embedding = self.embedding_model.embed_query(question or user_input)
+        cached = self.response_cache.lookup(embedding, namespace)
+        if cached is not None:
+            self._record_cached_turn(user_input, cached)
+            return cached
+
         # A dummy session_id is used because StreamlitChatMessageHistory is managed by its key.
-        return self.chain_with_history.invoke(
+        response = self.chain_with_history.invoke(
             {"input": user_input},
             config={"configurable": {"session_id": "default_session"}}
-        )
\ No newline at end of file
+        )
+        self.response_cache.add(embedding, response, namespace)
+        return response
+
+    async def arun(self, user_input: str, question: str | None = None):
+        """
+        Async counterpart of run(): awaits the LLM and retriever calls instead of blocking,
+        so several questions can be answered concurrently from one event loop.
+        """
+        namespace = self._cache_namespace()
+        embedding = await self.embedding_model.aembed_query(question or user_input)
+        cached = self.response_cache.lookup(embedding, namespace)
+        if cached is not None:
+            self._record_cached_turn(user_input, cached)
+            return cached
+
+        response = await self.chain_with_history.ainvoke(
+            {"input": user_input},
+            config={"configurable": {"session_id": "default_session"}}
+        )
+        self.response_cache.add(embedding, response, namespace)
+        return response
+
+    def stream(self, user_input: str, question: str | None = None):
+        """
+        Streams the answer token by token; history is updated once the stream completes.
+        """
+        namespace = self._cache_namespace()
+        embedding = self.embedding_model.embed_query(question or user_input)
+        cached = self.response_cache.lookup(embedding, namespace)
+        if cached is not None:
+            self._record_cached_turn(user_input, cached)
+            yield cached
+            return
+
+        chunks = []
+        for chunk in self.chain_with_history.stream(
+            {"input": user_input},
+            config={"configurable": {"session_id": "default_session"}}
+        ):
+            chunks.append(chunk)
+            yield chunk
+        self.response_cache.add(embedding, "".join(chunks), namespace)
+
+    def get_cache_stats(self) -> dict:
+        """Returns semantic cache hit/miss statistics."""
+        return self.response_cache.get_stats()
\ No newline at end of file
@@ -0,0 +1,94 @@
+import time
+import threading
+import numpy as np
+
+
+class SemanticCache:
+    """
+    In-memory cache of LLM answers keyed by the embedding of the question.
+
+    A lookup returns a cached answer when its question's cosine similarity to the
+    new one is at least `threshold` and both were cached under the same `namespace`
+    (any hashable, e.g. the filters the answer was produced with). Entries expire
+    after `ttl` seconds, and the least recently used entry is evicted once
+    `max_entries` is reached.
+    """
+    def __init__(self, threshold: float = 0.95, ttl: float = 300, max_entries: int = 256):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._vectors = None  # (n, dim) matrix of unit-normalised question embeddings
+        self._responses: list[str] = []
+        self._namespaces: list = []
+        self._created: list[float] = []
+        self._last_used: list[float] = []
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _normalise(embedding) -> np.ndarray:
+        vec = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vec)
+        return vec / norm if norm else vec
+
+    def _drop(self, keep: np.ndarray):
+        self._vectors = self._vectors[keep]
+        self._responses = [r for r, k in zip(self._responses, keep) if k]
+        self._namespaces = [n for n, k in zip(self._namespaces, keep) if k]
+        self._created = [c for c, k in zip(self._created, keep) if k]
+        self._last_used = [u for u, k in zip(self._last_used, keep) if k]
+
+    def _expire(self, now: float):
+        if self._responses and now - min(self._created) > self.ttl:
+            self._drop(np.array([now - c <= self.ttl for c in self._created], dtype=bool))
+
+    def lookup(self, embedding, namespace=None):
+        """
+        Returns the cached answer for the most similar question in `namespace`, or None on a miss.
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            if not self._responses:
+                self.misses += 1
+                return None
+            # One matrix-vector product scores every cached question at once
+            sims = self._vectors @ self._normalise(embedding)
+            same = np.fromiter((n == namespace for n in self._namespaces), dtype=bool, count=len(self._namespaces))
+            sims = np.where(same, sims, -np.inf)
+            best = int(np.argmax(sims))
+            if sims[best] < self.threshold:
+                self.misses += 1
+                return None
+            self._last_used[best] = now
+            self.hits += 1
+            return self._responses[best]
+
+    def add(self, embedding, response: str, namespace=None):
+        """
+        Caches an answer, evicting the least recently used entry when full.
+        """
+        now = time.monotonic()
+        vec = self._normalise(embedding)[np.newaxis, :]
+        with self._lock:
+            self._expire(now)
+            if len(self._responses) >= self.max_entries:
+                keep = np.ones(len(self._responses), dtype=bool)
+                keep[int(np.argmin(self._last_used))] = False
+                self._drop(keep)
+            self._vectors = vec if self._vectors is None or not len(self._responses) else np.vstack([self._vectors, vec])
+            self._responses.append(response)
+            self._namespaces.append(namespace)
+            self._created.append(now)
+            self._last_used.append(now)
+
+    def get_stats(self) -> dict:
+        """Returns hit/miss counters and the current hit rate."""
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "size": len(self._responses),
+        }
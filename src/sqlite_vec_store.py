@@ -0,0 +1,143 @@
+import os
+import json
+import sqlite3
+import threading
+from array import array
+from typing import Any
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+try:
+    # Optional: only needed for the local (sqlite_vec) vector store backend
+    import sqlite_vec
+except ImportError:
+    sqlite_vec = None
+
+# Extra candidates fetched per result when a metadata filter is applied after the KNN search
+FILTER_OVERSAMPLE = 4
+
+def connect(path: str, dimensions: int) -> sqlite3.Connection:
+    """
+    Opens (creating if needed) an on-disk sqlite-vec index.
+
+    Raises:
+        RuntimeError: If the sqlite-vec extension is unavailable or cannot be loaded.
+    """
+    if sqlite_vec is None:
+        raise RuntimeError("the sqlite-vec package is not installed")
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    conn = sqlite3.connect(path, check_same_thread=False)
+    try:
+        conn.enable_load_extension(True)
+        sqlite_vec.load(conn)
+        conn.enable_load_extension(False)
+    except (AttributeError, sqlite3.OperationalError) as e:
+        # AttributeError: this Python's sqlite3 was built without extension loading
+        conn.close()
+        raise RuntimeError(f"could not load the sqlite-vec extension: {e}") from e
+    conn.execute("CREATE TABLE IF NOT EXISTS ads (rowid INTEGER PRIMARY KEY, id TEXT UNIQUE NOT NULL, text TEXT, metadata TEXT)")
+    conn.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS vec_ads USING vec0(embedding float[{dimensions}])")
+    return conn
+
+def upsert_records(conn: sqlite3.Connection, records):
+    """Inserts or replaces (id, vector, text, metadata) records; the caller commits."""
+    for vec_id, vector, text, metadata in records:
+        (rowid,) = conn.execute(
+            "INSERT INTO ads (id, text, metadata) VALUES (?, ?, ?) "
+            "ON CONFLICT(id) DO UPDATE SET text = excluded.text, metadata = excluded.metadata "
+            "RETURNING rowid",
+            (vec_id, text, json.dumps(metadata, ensure_ascii=False)),
+        ).fetchone()
+        # vec0 tables have no upsert, so replace the row outright
+        conn.execute("DELETE FROM vec_ads WHERE rowid = ?", (rowid,))
+        conn.execute("INSERT INTO vec_ads (rowid, embedding) VALUES (?, ?)", (rowid, array("f", vector).tobytes()))
+
+def _matches(metadata: dict, metadata_filter: dict) -> bool:
+    """Evaluates the $eq/$in subset of Pinecone's filter syntax used by the app."""
+    for key, condition in metadata_filter.items():
+        value = metadata.get(key)
+        if "$eq" in condition and value != condition["$eq"]:
+            return False
+        if "$in" in condition and value not in condition["$in"]:
+            return False
+    return True
+
+class SqliteVecStore:
+    """
+    Local, in-process alternative to PineconeVectorStore backed by a sqlite-vec index.
+
+    Implements the small part of the vector store interface VectorDB relies on.
+    Searches are exact KNN by L2 distance (lower is closer); MMR is not applied.
+    """
+    def __init__(self, path: str, dimensions: int, embedding):
+        self.embedding = embedding
+        self._conn = connect(path, dimensions)
+        # One connection is shared by the retriever and batch_retrieve's worker threads
+        self._lock = threading.Lock()
+
+    def count(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM ads").fetchone()[0]
+
+    @staticmethod
+    def relevance(distance: float) -> float:
+        """
+        Maps an L2 distance between unit vectors to 0-1 relevance, (cosine + 1) / 2,
+        the same scale PineconeVectorStore uses for score thresholds.
+        """
+        return 1 - distance * distance / 4
+
+    def similarity_search_by_vector_with_score(self, embedding, k: int = 4, filter: dict | None = None) -> list:
+        """Returns up to k (Document, distance) pairs, nearest first."""
+        fetch_k = k * FILTER_OVERSAMPLE if filter else k
+        with self._lock:
+            rows = self._conn.execute(
+                "WITH knn AS (SELECT rowid, distance FROM vec_ads WHERE embedding MATCH ? AND k = ?) "
+                "SELECT ads.text, ads.metadata, knn.distance FROM knn JOIN ads ON ads.rowid = knn.rowid "
+                "ORDER BY knn.distance",
+                (array("f", embedding).tobytes(), fetch_k),
+            ).fetchall()
+
+        results = []
+        for text, metadata, distance in rows:
+            metadata = json.loads(metadata)
+            if filter and not _matches(metadata, filter):
+                continue
+            results.append((Document(page_content=text, metadata=metadata), distance))
+            if len(results) == k:
+                break
+        return results
+
+    def _select_relevance_score_fn(self):
+        """Distance -> 0-1 relevance, matching the LangChain VectorStore hook of the same name."""
+        return self.relevance
+
+    def max_marginal_relevance_search_by_vector(self, embedding, k: int = 4, fetch_k: int = 20,
+                                                lambda_mult: float = 0.5, filter: dict | None = None) -> list:
+        """Signature-compatible with PineconeVectorStore; MMR is not applied, so this is a plain KNN search."""
+        return [doc for doc, _ in self.similarity_search_by_vector_with_score(embedding, k=k, filter=filter)]
+
+    def as_retriever(self, search_type: str | None = None, search_kwargs: dict | None = None):
+        """Returns a retriever; search_type and MMR-only kwargs are accepted and ignored."""
+        search_kwargs = search_kwargs or {}
+        return SqliteVecRetriever(
+            store=self,
+            k=search_kwargs.get("k", 4),
+            filter=search_kwargs.get("filter"),
+            score_threshold=search_kwargs.get("score_threshold"),
+        )
+
+class SqliteVecRetriever(BaseRetriever):
+    """LangChain retriever over a SqliteVecStore."""
+    store: Any
+    k: int = 4
+    filter: dict | None = None
+    score_threshold: float | None = None
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> list:
+        vector = self.store.embedding.embed_query(query)
+        results = self.store.similarity_search_by_vector_with_score(vector, k=self.k, filter=self.filter)
+        return [
+            doc for doc, distance in results
+            if self.score_threshold is None or self.store.relevance(distance) >= self.score_threshold
+        ]
@@ -1,3 +1,5 @@
+import bisect
+from datetime import datetime, timedelta, timezone
 import streamlit as st
 from src.app_config import (
     CAMPAIGN_OBJECTIVES,
@@ -6,34 +8,122 @@ from src.app_config import (
     AD_FORMATS
 )
 
-def render_sidebar(saved_sessions: list):
+# Max session buttons rendered per date bucket before "Show more" is needed
+SIDEBAR_PAGE_SIZE = 25
+
+# session_id -> (archived, live) messages of a left session whose save is still in flight
+PARKED_TRANSCRIPTS_KEY = "parked_transcripts"
+
+# (label, max age in days); None means no upper bound
+SESSION_BUCKETS = (
+    ("Today", 1),
+    ("Last 7 days", 7),
+    ("Last 30 days", 30),
+    ("Older", None),
+)
+
+def _bucket_sessions(saved_sessions: list) -> list:
     """
-    Renders the sidebar UI components and returns user actions.
-    
-    Args:
-        saved_sessions (list): A list of saved session dictionaries.
-    
+    Partitions sessions into SESSION_BUCKETS by age, newest first.
+
     Returns:
-        str or None: The session_id of a selected chat, or None if no selection is made.
+        list: (label, sessions) tuples in SESSION_BUCKETS order.
+    """
+    now = datetime.now(timezone.utc)
+    ordered = sorted(saved_sessions, key=lambda s: s['last_modified'], reverse=True)
+    ages = [now - s['last_modified'] for s in ordered]  # ascending
+
+    buckets = []
+    start = 0
+    for label, days in SESSION_BUCKETS:
+        if days is None:
+            end = len(ordered)
+        else:
+            end = bisect.bisect_right(ages, timedelta(days=days), lo=start)
+        buckets.append((label, ordered[start:end]))
+        start = end
+    return buckets
+
+# Widget actions run as on_click callbacks: Streamlit applies them before the rerun the
+# click triggers, so the new state renders in one pass instead of needing a second st.rerun().
+
+def _new_chat(on_leave=None):
+    pending = on_leave() if on_leave else None
+    # Drop the previous session's in-memory transcript; it is reloaded from S3 if reopened
+    previous = st.session_state.get("session_id")
+    transcript = (st.session_state.pop(f"archived_{previous}", []), st.session_state.pop(f"history_{previous}", []))
+    if pending is not None:
+        # Until the upload lands S3 holds a partial copy, so park the transcript for a quick reopen.
+        # A plain dict, because the done-callback runs on the save worker, not the script thread.
+        parked = st.session_state.setdefault(PARKED_TRANSCRIPTS_KEY, {})
+        parked[previous] = transcript
+        total = sum(map(len, transcript))
+
+        def release(future):
+            # Kept if the save failed, so a reopen resumes from memory and saves again
+            if future.exception() is None and future.result() >= total and parked.get(previous) is transcript:
+                del parked[previous]
+
+        pending.add_done_callback(release)
+    st.session_state.pop(f"rag_chain_{previous}", None)
+    st.session_state.session_id = None # Signal to create a new session
+
+def take_parked_transcript(session_id: str):
+    """
+    Returns (archived, live) messages parked by "New Chat" while their save was in
+    flight, removing them, or None if the session is not parked.
+    """
+    return st.session_state.get(PARKED_TRANSCRIPTS_KEY, {}).pop(session_id, None)
+
+def _select_session(session_id: str, on_leave=None):
+    if on_leave:
+        on_leave()
+    st.session_state.session_id = session_id
+
+def _show_more(limit_key: str, limit: int):
+    st.session_state[limit_key] = limit + SIDEBAR_PAGE_SIZE
+
+def render_sidebar(on_leave=None):
+    """
+    Renders the sidebar header and the "New Chat" action.
+
+    Args:
+        on_leave (callable, optional): Called before switching away from the active session;
+            may return the Future of a pending save, in which case the old session's
+            transcript stays parked in memory until that save has persisted it.
     """
     st.title("Chat Conversation")
         
-    if st.button("➕ New Chat"):
-        st.session_state.session_id = None # Signal to create a new session
-        st.rerun()
+    st.button("➕ New Chat", on_click=_new_chat, args=(on_leave,))
 
     st.markdown("---")
+
+def render_session_list(saved_sessions: list, on_leave=None):
+    """
+    Renders the past-conversation buttons; selecting one switches the active session.
     
+    Args:
+        saved_sessions (list): A list of saved session dictionaries.
+        on_leave (callable, optional): Called before switching away from the active session.
+    """
     if not saved_sessions:
         st.write("No saved conversations yet.")
     else:
         st.markdown("Past Conversations:")
-        for session in saved_sessions:
-            session_id = session['session_id']
-            title = f"Chat from {session['last_modified'].strftime('%Y-%m-%d %H:%M')}"
-            if st.button(title, key=session_id, use_container_width=True):
-                st.session_state.session_id = session_id
-                st.rerun()
+        for label, sessions in _bucket_sessions(saved_sessions):
+            if not sessions:
+                continue
+
+            limit_key = f"sidebar_limit_{label}"
+            limit = st.session_state.get(limit_key, SIDEBAR_PAGE_SIZE)
+            with st.expander(f"{label} ({len(sessions)})", expanded=label == "Today"):
+                for session in sessions[:limit]:
+                    session_id = session['session_id']
+                    st.button(session['title'], key=session_id, use_container_width=True,
+                              on_click=_select_session, args=(session_id, on_leave))
+
+                if len(sessions) > limit:
+                    st.button("Show more", key=f"more_{label}", on_click=_show_more, args=(limit_key, limit))
 
 def render_filters() -> dict:
     """
@@ -55,12 +145,25 @@ def render_filters() -> dict:
 
     return filters
 
-def render_chat_interface(chat_history):
+def render_chat_interface(chat_history, earlier_count: int = 0) -> bool:
     """
     Renders the main chat message display area.
+
+    Args:
+        chat_history: The live (windowed) chat message history.
+        earlier_count (int): Number of older messages not currently loaded.
+
+    Returns:
+        bool: True if the user asked to show earlier messages.
     """
     st.title("🤖 Multimodal RAG LLM Chatbot")
     st.caption("An AI assistant/ideation for the Inhouse INVOKE's Digital Marketing Team")
 
+    show_earlier = False
+    if earlier_count:
+        show_earlier = st.button(f"Show earlier messages ({earlier_count})")
+
     for msg in chat_history.messages:
-        st.chat_message(msg.type).write(msg.content)
\ No newline at end of file
+        st.chat_message(msg.type).write(msg.content)
+
+    return show_earlier
\ No newline at end of file
@@ -1,15 +1,110 @@
 import os
 import json
+import atexit
+import time
+import threading
+import functools
+import importlib.util
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timezone
 import boto3
-from botocore.exceptions import ClientError
+import httpx
+import yaml
+try:
+    # libyaml-backed loader; falls back to the pure-Python one if PyYAML was built without it
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+from botocore.exceptions import BotoCoreError, ClientError
 from langchain_core.messages import AIMessage, HumanMessage
 
+# --- Config Loading ---
+CONFIG_PATH = "config/config.yaml"
+
+# path -> ((st_mtime_ns, st_size, st_ino), parsed dict)
+_CONFIG_CACHE: dict[str, tuple[tuple[int, int, int], dict]] = {}
+_CONFIG_LOCK = threading.Lock()
+
+def load_config(path: str = CONFIG_PATH) -> dict:
+    """
+    Loads a YAML config file, re-parsing it only when the file changes on disk.
+
+    Streamlit re-executes the app on every interaction, so the parsed result is
+    cached in-process and keyed by the file's mtime, size and inode.
+    """
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return {}
+    sig = (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    with _CONFIG_LOCK:
+        cached = _CONFIG_CACHE.get(path)
+        if cached and cached[0] == sig:
+            return cached[1]
+
+        data = _load_config_sidecar(path, st.st_mtime_ns)
+        if data is None:
+            with open(path, 'r') as f:
+                data = yaml.load(f, Loader=SafeLoader) or {}
+            _write_config_sidecar(path, data)
+        _CONFIG_CACHE[path] = (sig, data)
+        return data
+
+def _load_config_sidecar(path: str, yaml_mtime_ns: int):
+    """
+    Returns the parsed `<path>.json` sidecar if it is newer than the YAML, else None.
+    """
+    json_path = f"{path}.json"
+    try:
+        if os.stat(json_path).st_mtime_ns <= yaml_mtime_ns:
+            return None
+        with open(json_path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def _write_config_sidecar(path: str, data: dict):
+    """
+    Writes a JSON copy of the parsed YAML so later process starts can skip YAML parsing.
+    """
+    try:
+        with open(f"{path}.json", 'w') as f:
+            json.dump(data, f)
+    except (OSError, TypeError) as e:
+        print(f"Warning: could not write config cache for {path}: {e}")
+
+# --- OpenAI HTTP Client ---
+# httpx only speaks HTTP/2 when the optional `h2` package is installed
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+@functools.lru_cache(maxsize=1)
+def get_http_client() -> httpx.Client:
+    """
+    Returns a process-wide httpx client for the OpenAI SDK clients.
+
+    Every ChatOpenAI/OpenAIEmbeddings instance shares its keep-alive pool, and
+    with HTTP/2 (when `h2` is installed) concurrent requests in a turn are
+    multiplexed over one TLS connection instead of opening one each.
+    """
+    return httpx.Client(
+        http2=HTTP2_AVAILABLE,
+        limits=httpx.Limits(max_keepalive_connections=20, max_connections=40),
+        timeout=httpx.Timeout(60.0, connect=10.0),
+    )
+
 # --- S3 Configuration ---
 S3_BUCKET_NAME = os.getenv("AWS_S3_BUCKET_NAME")
 S3_PREFIX = "chat_history/" # Use a prefix to keep chat logs organized
 
+@functools.lru_cache(maxsize=1)
 def get_s3_client():
-    """Initializes and returns a Boto3 S3 client."""
+    """
+    Initializes and returns a Boto3 S3 client.
+
+    The client is created once per process; boto3 clients are thread-safe and
+    building one on every Streamlit rerun is comparatively expensive.
+    """
     return boto3.client(
         's3',
         aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"),
@@ -17,63 +112,192 @@ def get_s3_client():
         region_name=os.getenv("AWS_DEFAULT_REGION")
     )
 
-def save_chat_history(session_id: str, messages: list):
+def _segment_key(session_id: str, offset: int) -> str:
+    """S3 key of the transcript segment whose first message is at `offset`."""
+    return f"{S3_PREFIX}{session_id}/{offset:08d}.jsonl"
+
+def _meta_key(session_id: str) -> str:
+    """S3 key of the small per-session metadata object read by the sidebar."""
+    return f"{S3_PREFIX}{session_id}.meta.json"
+
+def _to_message(msg: dict):
+    """Deserializes a stored message dict back into a LangChain message object (or None)."""
+    if msg['type'] == 'human':
+        return HumanMessage(content=msg['content'])
+    if msg['type'] == 'ai':
+        return AIMessage(content=msg['content'])
+    return None
+
+def save_chat_history(session_id: str, messages: list, saved_len: int = 0, title: str | None = None) -> int:
     """
-    Saves a list of LangChain message objects to an S3 bucket as a JSON file.
+    Appends the messages not yet persisted to the session's S3 transcript.
+
+    A transcript is a series of JSONL segments, `chat_history/<session_id>/<offset>.jsonl`,
+    one JSON object per message. Only `messages[saved_len:]` is uploaded, so each
+    save costs O(new messages) rather than re-uploading the whole conversation.
+    `title` is shown in the sidebar; stored messages carry the prompt preamble, so
+    callers pass the user's own first question.
+
+    Returns:
+        int: The number of messages now persisted (pass back as `saved_len` next time).
     """
     if not S3_BUCKET_NAME:
         print("Warning: AWS_S3_BUCKET_NAME not set. Chat history will not be saved.")
-        return
+        return saved_len
+
+    new_messages = messages[saved_len:]
+    if not new_messages:
+        return saved_len
 
     s3_client = get_s3_client()
-    s3_key = f"{S3_PREFIX}{session_id}.json"
-    
-    # Serialize LangChain message objects to a JSON-compatible format
-    serializable_messages = [{"type": msg.type, "content": msg.content} for msg in messages]
+    ts = time.time()
+    body = "".join(
+        json.dumps({"type": msg.type, "content": msg.content, "ts": ts}, ensure_ascii=False) + "\n"
+        for msg in new_messages
+    )
     
     try:
         s3_client.put_object(
             Bucket=S3_BUCKET_NAME,
-            Key=s3_key,
-            Body=json.dumps(serializable_messages, indent=2),
+            Key=_segment_key(session_id, saved_len),
+            Body=body.encode('utf-8'),
+            ContentType='application/x-ndjson'
+        )
+        # Title/last_modified live in a tiny sidecar so listing sessions never reads transcripts
+        meta = {
+            "title": (title or "")[:60] or "New chat",
+            "last_modified": datetime.fromtimestamp(ts, timezone.utc).isoformat(),
+            "message_count": len(messages),
+            "summary": None,
+        }
+        s3_client.put_object(
+            Bucket=S3_BUCKET_NAME,
+            Key=_meta_key(session_id),
+            Body=json.dumps(meta, ensure_ascii=False).encode('utf-8'),
             ContentType='application/json'
         )
-    except ClientError as e:
+    except (ClientError, BotoCoreError) as e:
+        # Nothing past saved_len counts as persisted, so the next save re-uploads it
         print(f"Error saving chat history to S3: {e}")
+        return saved_len
+    return len(messages)
+
+# Background uploads for chat transcripts; pending saves are flushed on interpreter exit
+_SAVE_POOL = ThreadPoolExecutor(max_workers=2, thread_name_prefix="chat-save")
+atexit.register(_SAVE_POOL.shutdown, wait=True)
+# session_id -> most recently queued save, so saves of one session run in order
+_LAST_SAVE: dict[str, Future] = {}
+_LAST_SAVE_LOCK = threading.Lock()
+
+def save_chat_history_async(session_id: str, messages: list, saved_len: int = 0, title: str | None = None) -> Future:
+    """
+    Queues save_chat_history on a background worker so the UI never waits on S3.
+
+    The message list is copied so later mutations by the caller don't leak into the upload.
+    A save queued while an earlier one for the same session is pending starts from that
+    save's result instead of `saved_len`, so a failed upload is retried rather than
+    leaving a hole in the segment offsets.
+
+    Returns:
+        Future: Resolves to the number of messages persisted.
+    """
+    messages = list(messages)
+    with _LAST_SAVE_LOCK:
+        previous = _LAST_SAVE.get(session_id)
+
+        def job():
+            start = previous.result() if previous is not None else saved_len
+            return save_chat_history(session_id, messages, start, title)
+
+        future = _SAVE_POOL.submit(job)
+        _LAST_SAVE[session_id] = future
+    future.add_done_callback(lambda f: _forget_save(session_id, f))
+    return future
+
+def _forget_save(session_id: str, future: Future):
+    with _LAST_SAVE_LOCK:
+        if _LAST_SAVE.get(session_id) is future:
+            del _LAST_SAVE[session_id]
 
 def load_chat_history(session_id: str) -> list:
     """
-    Loads and deserializes a chat history from an S3 JSON file.
+    Loads and deserializes a chat history from its S3 JSONL segments.
+
+    Only the contiguous run of segments from offset 0 is returned; anything past a
+    missing offset is left in place and ignored. Falls back to the legacy single-file `chat_history/<session_id>.json` layout.
     """
     if not S3_BUCKET_NAME:
         return []
 
     s3_client = get_s3_client()
-    s3_key = f"{S3_PREFIX}{session_id}.json"
+    segment_prefix = f"{S3_PREFIX}{session_id}/"
     
     try:
-        response = s3_client.get_object(Bucket=S3_BUCKET_NAME, Key=s3_key)
-        content = response['Body'].read().decode('utf-8')
-        dict_messages = json.loads(content)
-        
-        # Deserialize back into LangChain message objects
+        paginator = s3_client.get_paginator('list_objects_v2')
+        segment_keys = sorted(
+            obj['Key']
+            for page in paginator.paginate(Bucket=S3_BUCKET_NAME, Prefix=segment_prefix)
+            for obj in page.get('Contents', [])
+            if obj['Key'].endswith(".jsonl")
+        )
+        if not segment_keys:
+            return _load_legacy_chat_history(s3_client, session_id)
+
+        offsets = {int(key[len(segment_prefix):-len(".jsonl")]): key for key in segment_keys}
         messages = []
-        for msg in dict_messages:
-            if msg['type'] == 'human':
-                messages.append(HumanMessage(content=msg['content']))
-            elif msg['type'] == 'ai':
-                messages.append(AIMessage(content=msg['content']))
+        count = 0
+        last_ts = None
+        # Follow the chain of segments, each starting where the previous one ended
+        while count in offsets:
+            response = s3_client.get_object(Bucket=S3_BUCKET_NAME, Key=offsets[count])
+            records = [json.loads(line) for line in response['Body'].iter_lines() if line]
+            if not records:
+                break
+            # A segment older than the one before it was left behind by an earlier, lost
+            # save; the next save overwrites it from this offset
+            if last_ts is not None and records[0].get("ts", last_ts) < last_ts:
+                break
+            count += len(records)
+            last_ts = records[-1].get("ts", last_ts)
+            messages.extend(m for m in map(_to_message, records) if m is not None)
+        if any(offset >= count for offset in offsets):
+            # Read-only on purpose: a concurrent save may be writing these keys right now
+            print(f"Warning: chat history {session_id} has a gap after message {count}; "
+                  "later segments are ignored and the next save continues from there.")
         return messages
-    except ClientError as e:
+    except (ClientError, BotoCoreError) as e:
+        print(f"Error loading chat history from S3: {e}")
+        return []
+
+def _load_legacy_chat_history(s3_client, session_id: str) -> list:
+    """Loads a transcript saved in the old whole-file JSON format."""
+    try:
+        response = s3_client.get_object(Bucket=S3_BUCKET_NAME, Key=f"{S3_PREFIX}{session_id}.json")
+        dict_messages = json.loads(response['Body'].read().decode('utf-8'))
+        return [m for m in map(_to_message, dict_messages) if m is not None]
+    except (ClientError, BotoCoreError) as e:
         # If the file doesn't exist (e.g., a new chat), return an empty list
-        if e.response['Error']['Code'] == 'NoSuchKey':
+        if isinstance(e, ClientError) and e.response['Error']['Code'] == 'NoSuchKey':
             return []
         print(f"Error loading chat history from S3: {e}")
         return []
 
+def _read_session_title(s3_client, key: str):
+    """Reads the title from a session's metadata object, or None if it can't be read."""
+    try:
+        response = s3_client.get_object(Bucket=S3_BUCKET_NAME, Key=key)
+        return json.loads(response['Body'].read()).get("title")
+    except (ClientError, BotoCoreError, ValueError) as e:
+        print(f"Error reading session metadata {key}: {e}")
+        return None
+
 def get_saved_sessions() -> list:
     """
-    Lists all saved session IDs from the S3 bucket, sorted by last modified.
+    Lists all saved sessions from the S3 bucket, sorted by last modified.
+
+    Only the top level of the prefix is listed (transcript segments sit one level
+    down), and titles come from each session's small `.meta.json` object, fetched
+    in parallel. Each entry carries session_id, title and last_modified.
     """
     if not S3_BUCKET_NAME:
         return []
@@ -82,24 +306,35 @@ def get_saved_sessions() -> list:
     sessions = []
     try:
         paginator = s3_client.get_paginator('list_objects_v2')
-        pages = paginator.paginate(Bucket=S3_BUCKET_NAME, Prefix=S3_PREFIX)
+        pages = paginator.paginate(Bucket=S3_BUCKET_NAME, Prefix=S3_PREFIX, Delimiter="/")
         
-        all_objects = []
+        # session_id -> S3 object for its metadata (preferred) or legacy transcript
+        objects = {}
         for page in pages:
-            if 'Contents' in page:
-                all_objects.extend(page['Contents'])
-        
-        # Sort objects by last modified time, newest first
-        sorted_objects = sorted(all_objects, key=lambda obj: obj['LastModified'], reverse=True)
+            for obj in page.get('Contents', []):
+                # e.g. 'chat_history/session123.meta.json' or legacy 'chat_history/session123.json'
+                name = obj['Key'][len(S3_PREFIX):]
+                if name.endswith(".meta.json"):
+                    objects[name.removesuffix(".meta.json")] = obj
+                elif name.endswith(".json"):
+                    objects.setdefault(name.removesuffix(".json"), obj)
+        objects.pop("", None) # Avoid including the prefix folder itself
         
-        for obj in sorted_objects:
-            key = obj['Key']
-            # Extract session_id from the key (e.g., 'chat_history/session123.json')
-            session_id = key.replace(S3_PREFIX, "").replace(".json", "")
-            if session_id: # Avoid including the prefix folder itself
-                sessions.append({"session_id": session_id, "last_modified": obj['LastModified']})
+        # Sort sessions by last modified time, newest first
+        ordered = sorted(objects.items(), key=lambda item: item[1]['LastModified'], reverse=True)
+        meta_keys = [obj['Key'] for _, obj in ordered if obj['Key'].endswith(".meta.json")]
+        with ThreadPoolExecutor(max_workers=16) as pool:
+            titles = dict(zip(meta_keys, pool.map(lambda key: _read_session_title(s3_client, key), meta_keys)))
+
+        for session_id, obj in ordered:
+            modified = obj['LastModified']
+            sessions.append({
+                "session_id": session_id,
+                "title": titles.get(obj['Key']) or f"Chat from {modified.strftime('%Y-%m-%d %H:%M')}",
+                "last_modified": modified,
+            })
                 
-    except ClientError as e:
+    except (ClientError, BotoCoreError) as e:
         print(f"Error listing saved sessions from S3: {e}")
     
-    return sessions
\ No newline at end of file
+    return sessions
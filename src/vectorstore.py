@@ -1,20 +1,194 @@
 import os
+import functools
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 from pinecone import Pinecone
+from langchain_core.embeddings import Embeddings
 from langchain_openai import OpenAIEmbeddings
 from langchain_pinecone import PineconeVectorStore
+from src.utils import load_config, get_http_client
+from src.sqlite_vec_store import SqliteVecStore
 
 load_dotenv()
 
+# Query embeddings kept in memory; least recently used ones are dropped beyond this
+QUERY_EMBEDDING_CACHE_SIZE = 1024
+SEARCH_THREADS = 4
+SQLITE_VEC_PATH = ".cache/vectors.db"
+
+# Sidebar "Ad Format" label -> format_category stored in the index metadata (see get_data.py)
+AD_FORMAT_CATEGORIES = {
+    "Image": "Static Image",
+    "Video": "Video/Reel",
+    "Carousel": "Carousel",
+}
+
+# Legacy campaign objective -> the Meta outcome-based objectives it was migrated to
+OUTCOME_OBJECTIVES = {
+    "APP_INSTALLS": ("OUTCOME_APP_PROMOTION",),
+    "BRAND_AWARENESS": ("OUTCOME_AWARENESS",),
+    "REACH": ("OUTCOME_AWARENESS",),
+    "VIDEO_VIEWS": ("OUTCOME_AWARENESS", "OUTCOME_ENGAGEMENT"),
+    "LINK_CLICKS": ("OUTCOME_TRAFFIC",),
+    "STORE_VISIT": ("STORE_VISITS", "OUTCOME_AWARENESS"),
+    "POST_ENGAGEMENT": ("OUTCOME_ENGAGEMENT",),
+    "PAGE_LIKES": ("OUTCOME_ENGAGEMENT",),
+    "EVENT_RESPONSES": ("OUTCOME_ENGAGEMENT",),
+    "MESSAGES": ("OUTCOME_ENGAGEMENT", "OUTCOME_LEADS", "OUTCOME_SALES"),
+    "LEAD_GENERATION": ("OUTCOME_LEADS",),
+    "CONVERSIONS": ("OUTCOME_SALES", "OUTCOME_LEADS"),
+    "PRODUCT_CATALOG_SALES": ("OUTCOME_SALES",),
+}
+
+def metadata_filter(filters: dict | None) -> dict | None:
+    """
+    Translates sidebar filters into a Pinecone metadata filter, or None if nothing is selected.
+
+    Only filters backed by indexed metadata are applied server-side; industry and
+    target market have no metadata field and are left to the prompt preamble.
+    """
+    if not filters:
+        return None
+    clauses = {}
+    ad_format = filters.get("ad_format", "All")
+    if ad_format in AD_FORMAT_CATEGORIES:
+        clauses["format_category"] = {"$eq": AD_FORMAT_CATEGORIES[ad_format]}
+    objective = filters.get("campaign_objective", "All")
+    if objective != "All":
+        # Older campaigns keep the legacy enum (e.g. LINK_CLICKS); newer ones use OUTCOME_* objectives
+        legacy = objective.upper().replace(" ", "_")
+        clauses["campaign_objective"] = {"$in": [legacy, *OUTCOME_OBJECTIVES.get(legacy, ())]}
+    return clauses or None
+
+class CachedQueryEmbeddings(Embeddings):
+    """
+    Wraps an embeddings model with a bounded in-memory LRU cache for query vectors,
+    so repeated questions skip the embeddings API. Document embedding is passed
+    straight through; ingest.py keeps its own on-disk cache for that.
+    """
+    def __init__(self, underlying: Embeddings, max_entries: int = QUERY_EMBEDDING_CACHE_SIZE):
+        self.underlying = underlying
+        self.max_entries = max_entries
+        self._cache: OrderedDict[str, list[float]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _cached(self, text: str):
+        with self._lock:
+            vector = self._cache.get(text)
+            if vector is not None:
+                self._cache.move_to_end(text)
+            return vector
+
+    def _remember(self, text: str, vector: list[float]):
+        with self._lock:
+            self._cache[text] = vector
+            self._cache.move_to_end(text)
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+
+    def embed_query(self, text: str) -> list[float]:
+        vector = self._cached(text)
+        if vector is None:
+            vector = self.underlying.embed_query(text)
+            self._remember(text, vector)
+        return vector
+
+    async def aembed_query(self, text: str) -> list[float]:
+        vector = self._cached(text)
+        if vector is None:
+            vector = await self.underlying.aembed_query(text)
+            self._remember(text, vector)
+        return vector
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return self.underlying.embed_documents(texts)
+
+    async def aembed_documents(self, texts: list[str]) -> list[list[float]]:
+        return await self.underlying.aembed_documents(texts)
+
+@functools.lru_cache(maxsize=1)
+def _pinecone_client(api_key: str) -> Pinecone:
+    """Returns a process-wide Pinecone client."""
+    return Pinecone(api_key=api_key)
+
+@functools.lru_cache(maxsize=8)
+def _index_exists(api_key: str, index_name: str) -> bool:
+    """Checks once per process whether the index exists (a control-plane round-trip)."""
+    return index_name in _pinecone_client(api_key).list_indexes().names()
+
+@functools.lru_cache(maxsize=8)
+def _index_dimension(api_key: str, index_name: str) -> int:
+    """Vector size the index was created with (looked up once per process)."""
+    return _pinecone_client(api_key).describe_index(index_name).dimension
+
 class VectorDB:
     """
-    A connector class for a pre-populated Pinecone vector database.
-    Its sole purpose is to connect to the index and provide a retriever.
+    A connector class for a pre-populated vector database (Pinecone, or a local
+    sqlite-vec index in local mode). Its sole purpose is to provide a retriever.
     """
-    def __init__(self):
+    def __init__(self, backend: str | None = None):
         """
-        Initializes the connection to the Pinecone index.
+        Initializes the connection to the vector index.
+
+        Args:
+            backend (str, optional): "pinecone" or "sqlite_vec"; defaults to
+                                  `vector_store.backend` in config.yaml.
         """
+        config = load_config()
+
+        # Initialize the embedding model; queries must use the same model and size as ingest.py
+        embedding_config = config.get("embedding_model", {})
+        model_name = embedding_config.get("model_name", "text-embedding-3-small")
+        dimensions = int(embedding_config.get("dimensions", 1536))
+        # One VectorDB serves the whole process (see get_vector_db), so its query cache is shared
+        self.embedding_model = CachedQueryEmbeddings(
+            OpenAIEmbeddings(model=model_name, dimensions=dimensions, http_client=get_http_client())
+        )
+
+        store_config = config.get("vector_store", {})
+        self.backend = backend or store_config.get("backend", "pinecone")
+        self.vectorstore = None
+        if self.backend == "sqlite_vec":
+            self.vectorstore = self._connect_sqlite_vec(store_config.get("sqlite_path", SQLITE_VEC_PATH), dimensions)
+        if self.vectorstore is None:
+            self.backend = "pinecone"
+            self.vectorstore = self._connect_pinecone(dimensions)
+
+        # MMR over a wider candidate pool drops near-duplicate ads before they reach the LLM
+        retrieval_config = config.get("retrieval", {})
+        self.search_kwargs = {
+            "k": retrieval_config.get("k", 5),
+            "fetch_k": retrieval_config.get("fetch_k", 20),
+            "lambda_mult": retrieval_config.get("lambda_mult", 0.5),
+        }
+
+        # Optional relevance cut-off (0-1, higher is closer); when set, plain similarity search
+        # replaces MMR so weak matches can be dropped and the chain can skip the LLM entirely
+        self.score_threshold = retrieval_config.get("score_threshold")
+
+        # Vectors ingested before format_category/campaign_objective were stored lack those
+        # fields, so filtering on them would match nothing; enable after a full re-ingest
+        self.metadata_filters = bool(store_config.get("metadata_filters", False))
+
+        # Built once; the RAG chain asks for a retriever on every construction
+        self._retriever = self._make_retriever(self.search_kwargs)
+
+    def _connect_sqlite_vec(self, path: str, dimensions: int):
+        """Opens the local index, or returns None (falling back to Pinecone) if it is unusable."""
+        try:
+            store = SqliteVecStore(path, dimensions, self.embedding_model)
+        except RuntimeError as e:
+            print(f"Warning: sqlite-vec backend unavailable ({e}); falling back to Pinecone.")
+            return None
+        if not store.count():
+            print(f"Warning: local index {path} is empty (run ingest.py); falling back to Pinecone.")
+            return None
+        return store
+
+    def _connect_pinecone(self, dimensions: int):
+        """Verifies the Pinecone index exists and wraps it in a LangChain vector store."""
         self.pinecone_api_key = os.getenv("PINECONE_API_KEY")
         if not self.pinecone_api_key:
             raise ValueError("PINECONE_API_KEY is not set in the .env file.")
@@ -23,31 +197,100 @@ class VectorDB:
         if not self.index_name:
             raise ValueError("PINECONE_INDEX_NAME is not set in the .env file.")
 
-        # Initialize Pinecone client
-        pc = Pinecone(api_key=self.pinecone_api_key)
-        
         # Verify that the index exists
-        if self.index_name not in pc.list_indexes().names():
+        if not _index_exists(self.pinecone_api_key, self.index_name):
+            # Don't remember a miss: the index may be created by ingest.py while the app is running
+            _index_exists.cache_clear()
             raise ValueError(f"Pinecone index '{self.index_name}' not found. Please run ingest.py first.")
 
-        # Initialize the embedding model
-        self.embedding_model = OpenAIEmbeddings(model='text-embedding-3-small')
+        # Query vectors must be the size the index was built with, or every search fails
+        index_dimension = _index_dimension(self.pinecone_api_key, self.index_name)
+        if index_dimension != dimensions:
+            raise ValueError(
+                f"Pinecone index '{self.index_name}' stores {index_dimension}-d vectors but "
+                f"embedding_model.dimensions is {dimensions}. Re-run ingest.py into a new index "
+                f"or set the dimensions back to {index_dimension}."
+            )
 
         # Initialize the LangChain PineconeVectorStore wrapper
-        self.vectorstore = PineconeVectorStore(
+        return PineconeVectorStore(
             index_name=self.index_name,
             embedding=self.embedding_model
         )
 
-    def as_retriever(self, search_kwargs={'k': 5}):
+    def as_retriever(self, search_kwargs=None, filters: dict | None = None):
         """
         Returns the vector store instance configured as a retriever.
         
         Args:
-            search_kwargs (dict): A dictionary to configure search parameters,
+            search_kwargs (dict, optional): A dictionary to configure search parameters,
                                   such as the number of documents to retrieve ('k').
+                                  Defaults to the cached MMR retriever.
+            filters (dict, optional): Sidebar filter values; when `vector_store.metadata_filters`
+                                  is on, those backed by index metadata are applied as a
+                                  Pinecone-style metadata filter.
         
         Returns:
             A LangChain retriever object.
         """
-        return self.vectorstore.as_retriever(search_kwargs=search_kwargs)
\ No newline at end of file
+        pinecone_filter = metadata_filter(filters) if self.metadata_filters else None
+        if search_kwargs is None and pinecone_filter is None:
+            return self._retriever
+        search_kwargs = {**self.search_kwargs, **(search_kwargs or {})}
+        if pinecone_filter is not None:
+            search_kwargs["filter"] = pinecone_filter
+        return self._make_retriever(search_kwargs)
+
+    def _make_retriever(self, search_kwargs: dict):
+        """Builds an MMR retriever, or a score-threshold one when `retrieval.score_threshold` is set."""
+        if self.score_threshold is None:
+            return self.vectorstore.as_retriever(search_type="mmr", search_kwargs=search_kwargs)
+        search_kwargs = {key: value for key, value in search_kwargs.items() if key not in ("fetch_k", "lambda_mult")}
+        search_kwargs["score_threshold"] = self.score_threshold
+        return self.vectorstore.as_retriever(search_type="similarity_score_threshold", search_kwargs=search_kwargs)
+
+    def batch_retrieve(self, queries: list[str], k: int | None = None, filters: dict | None = None) -> list:
+        """
+        Retrieves documents for several queries at once, searching like the retriever does:
+        MMR with the configured k/fetch_k/lambda_mult, or a similarity search cut off at
+        `retrieval.score_threshold` when that is set.
+
+        All queries are embedded in a single API call, then the searches run in
+        parallel instead of one after another.
+
+        Args:
+            k (int, optional): Results per query; defaults to `retrieval.k`.
+
+        Returns:
+            list[list[Document]]: One result list per query, in input order.
+        """
+        if not queries:
+            return []
+        vectors = self.embedding_model.embed_documents(queries)
+        pinecone_filter = metadata_filter(filters) if self.metadata_filters else None
+        search_kwargs = {**self.search_kwargs, "filter": pinecone_filter}
+        if k is not None:
+            search_kwargs["k"] = k
+
+        if self.score_threshold is None:
+            def search(vector):
+                return self.vectorstore.max_marginal_relevance_search_by_vector(vector, **search_kwargs)
+        else:
+            relevance = self.vectorstore._select_relevance_score_fn()
+
+            def search(vector):
+                results = self.vectorstore.similarity_search_by_vector_with_score(
+                    vector, k=search_kwargs["k"], filter=pinecone_filter
+                )
+                return [doc for doc, score in results if relevance(score) >= self.score_threshold]
+
+        with ThreadPoolExecutor(max_workers=min(SEARCH_THREADS, len(vectors))) as pool:
+            return list(pool.map(search, vectors))
+
+@functools.lru_cache(maxsize=1)
+def get_vector_db() -> VectorDB:
+    """
+    Returns a process-wide VectorDB so the embeddings client and Pinecone
+    connection are set up once rather than on every Streamlit rerun.
+    """
+    return VectorDB()
@@ -1,80 +1,159 @@
 import os
+import io
+import sys
 import base64
+import hashlib
+import functools
+import mmap
 import json # Import for JSON processing
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 import openai
+from PIL import Image
+
+VISION_MODEL = "gpt-4o"
+# Bump when the prompts below change so cached extractions are not reused
+PROMPT_VERSION = "1"
+VISION_CACHE_DIR = ".cache/vision"
+# Concurrent vision requests in extract_many; bounded to respect the OpenAI rate limit
+VISION_THREADS = int(os.getenv("VISION_THREADS", 10))
+
+# gpt-4o tiles images at high detail and never needs more than this; larger uploads only cost bandwidth
+MAX_IMAGE_SIDE = 2048
+# Images this small fit a single low-detail tile, which is billed at a fraction of the tokens
+LOW_DETAIL_SIDE = 512
 
 def encode_image_to_base64(image_path):
-    """Encodes a local image file to a base64 string."""
+    """
+    Encodes a local image file to a base64 string.
+
+    Images larger than MAX_IMAGE_SIDE (or not JPEG/PNG) are downscaled and
+    re-encoded as JPEG first; everything else is sent as-is.
+    """
     try:
+        with Image.open(image_path) as img:
+            if max(img.size) > MAX_IMAGE_SIDE or img.format not in ("JPEG", "PNG"):
+                img.thumbnail((MAX_IMAGE_SIDE, MAX_IMAGE_SIDE), Image.LANCZOS)
+                buf = io.BytesIO()
+                img.convert("RGB").save(buf, format="JPEG", quality=85, optimize=True)
+                return base64.b64encode(buf.getbuffer()).decode('ascii')
         with open(image_path, "rb") as image_file:
-            return base64.b64encode(image_file.read()).decode('utf-8')
+            # Encode straight from the memory-mapped file instead of first reading it into a bytes copy
+            with mmap.mmap(image_file.fileno(), 0, access=mmap.ACCESS_READ) as image_data:
+                return base64.b64encode(image_data).decode('ascii')
+    except ValueError:
+        print(f"Error: Local image file is empty: {image_path}")
+        return None
     except FileNotFoundError:
         print(f"Error: Local image file not found at path: {image_path}")
         return None
+    except Image.UnidentifiedImageError:
+        print(f"Error: Not a readable image file: {image_path}")
+        return None
 
-def test_image_reading():
-    load_dotenv()
-    
+def image_detail(image_path) -> str:
+    """Picks the vision `detail` level: "low" for images that fit one low-detail tile."""
     try:
-        client = openai.OpenAI()
-    except Exception as e:
-        print(f"Error initializing OpenAI client: {e}")
-        print("Please ensure your OPENAI_API_KEY is set correctly in the .env file.")
-        return
+        with Image.open(image_path) as img:  # Only the header is read
+            return "low" if max(img.size) <= LOW_DETAIL_SIDE else "high"
+    except OSError:
+        return "high"
 
-    # Updated function to extract structured marketing data
-    def extract_marketing_data(base64_image: str, mime_type: str = "image/jpeg") -> str:
-        if not base64_image:
-            return "No image data provided."
-        
-        data_uri = f"data:{mime_type};base64,{base64_image}"
-        
-        print("Sending Base64 encoded image data for structured marketing analysis.")
-        
-        # --- Structured Prompting for Marketing Data ---
-        
-        system_prompt = "You are a Digital Marketing Analyst AI. Your task is to analyze the provided image, " \
-        "which is an advertisement, and extract all relevant marketing data points. You must identify the product," \
-        "offer, pricing, and all visible text."
-        
-        user_prompt = "Analyze this ad visual. Extract the Campaign Name, main Offer/Promotion, all specific Prices," \
-        "the Primary Call-to-Action (CTA) if visible, the Target Audience inferred from the content, and a descriptive " \
-        "label for the Visual Type (e.g., product photo, lifestyle ad, infographic)."
-
-        try:
-            response = client.chat.completions.create(
-                model="gpt-4o",
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {
-                        "role": "user",
-                        "content": [
-                            {"type": "text", "text": user_prompt},
-                            {"type": "image_url", "image_url": {"url": data_uri}},
-                        ],
-                    }
-                ],
-                max_tokens=512, # Increased tokens for detailed JSON output
-                response_format={"type": "json_object"} # Enforce JSON output
-            )
-            # The output is now a clean JSON string
-            json_string = response.choices[0].message.content
-            return json_string
-        except Exception as e:
-            # Added error handling to show the API-specific error message
-            return f"Error: Image analysis failed. Details: {e}"
+@functools.lru_cache(maxsize=1)
+def get_openai_client() -> openai.OpenAI:
+    """Returns a process-wide OpenAI client so its connection pool is reused across calls."""
+    # Retries back off exponentially (honouring Retry-After) on 429s and transient errors
+    return openai.OpenAI(max_retries=5)
 
-    # --- TEST EXECUTION ---
-    LOCAL_IMAGE_PATH = "testburger1.jpg"
-    base64_string = encode_image_to_base64(LOCAL_IMAGE_PATH)
+def vision_cache_path(base64_image: str, detail: str) -> str:
+    """Content-addressed cache file for one image + model + prompt version."""
+    key = hashlib.sha256(f"{VISION_MODEL}:{PROMPT_VERSION}:{detail}:".encode() + base64_image.encode('ascii')).hexdigest()
+    return os.path.join(VISION_CACHE_DIR, f"{key}.json")
+
+# Updated function to extract structured marketing data
+def extract_marketing_data(base64_image: str, mime_type: str = "image/jpeg", detail: str = "high", stream: bool = True) -> str:
+    if not base64_image:
+        return "No image data provided."
     
-    print("\n--- Starting Structured Marketing Data Extraction ---")
+    cache_path = vision_cache_path(base64_image, detail)
+    if os.path.exists(cache_path):
+        print("Using cached extraction for this image.")
+        with open(cache_path, "r", encoding="utf-8") as f:
+            return f.read()
+
+    data_uri = f"data:{mime_type};base64,{base64_image}"
+    
+    print("Sending Base64 encoded image data for structured marketing analysis.")
     
-    json_output = extract_marketing_data(base64_string)
+    # --- Structured Prompting for Marketing Data ---
     
-    print("\n--- Result (JSON Output for RAG Indexing) ---")
+    system_prompt = "You are a Digital Marketing Analyst AI. Your task is to analyze the provided image, " \
+    "which is an advertisement, and extract all relevant marketing data points. You must identify the product," \
+    "offer, pricing, and all visible text."
     
+    user_prompt = "Analyze this ad visual. Extract the Campaign Name, main Offer/Promotion, all specific Prices," \
+    "the Primary Call-to-Action (CTA) if visible, the Target Audience inferred from the content, and a descriptive " \
+    "label for the Visual Type (e.g., product photo, lifestyle ad, infographic)."
+
+    try:
+        response = get_openai_client().chat.completions.create(
+            model=VISION_MODEL,
+            messages=[
+                {"role": "system", "content": system_prompt},
+                {
+                    "role": "user",
+                    "content": [
+                        {"type": "text", "text": user_prompt},
+                        {"type": "image_url", "image_url": {"url": data_uri, "detail": detail}},
+                    ],
+                }
+            ],
+            max_tokens=512, # Increased tokens for detailed JSON output
+            response_format={"type": "json_object"}, # Enforce JSON output
+            stream=stream, # Show tokens as they arrive instead of waiting for the full reply
+        )
+        if stream:
+            parts = []
+            finish_reason = None
+            for chunk in response:
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content or ""
+                print(delta, end="", flush=True)
+                parts.append(delta)
+                finish_reason = chunk.choices[0].finish_reason or finish_reason
+            print()
+            # The output is now a clean JSON string; it is only complete once the stream ends
+            json_string = "".join(parts)
+        else:
+            json_string = response.choices[0].message.content
+            finish_reason = response.choices[0].finish_reason
+        if finish_reason == "stop":  # A truncated reply is not valid JSON, so don't cache it
+            os.makedirs(VISION_CACHE_DIR, exist_ok=True)
+            with open(cache_path, "w", encoding="utf-8") as f:
+                f.write(json_string)
+        return json_string
+    except Exception as e:
+        # Added error handling to show the API-specific error message
+        return f"Error: Image analysis failed. Details: {e}"
+
+def analyze_image(image_path, stream: bool = True) -> str:
+    """Encodes one local image and extracts its marketing data."""
+    return extract_marketing_data(encode_image_to_base64(image_path), detail=image_detail(image_path), stream=stream)
+
+def extract_many(image_paths, max_workers: int = VISION_THREADS) -> dict:
+    """
+    Extracts marketing data for several images concurrently. Returns {path: JSON string}.
+
+    The calls are network-bound, so a small thread pool keeps several requests in
+    flight; the client's retries back off on 429s when the rate limit is reached.
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # Interleaved token output from parallel streams would be unreadable
+        results = executor.map(lambda path: analyze_image(path, stream=False), image_paths)
+        return dict(zip(image_paths, results))
+
+def print_result(json_output: str):
     # Attempt to pretty-print the JSON output
     try:
         data = json.loads(json_output)
@@ -85,5 +164,31 @@ def test_image_reading():
         print("Error: Could not decode JSON. Raw output:")
         print(json_output)
 
+def test_image_reading(image_paths=None):
+    load_dotenv()
+    
+    try:
+        get_openai_client()
+    except Exception as e:
+        print(f"Error initializing OpenAI client: {e}")
+        print("Please ensure your OPENAI_API_KEY is set correctly in the .env file.")
+        return
+
+    # --- TEST EXECUTION ---
+    # Paths from the command line, else VISION_TEST_IMAGES (comma-separated)
+    LOCAL_IMAGE_PATHS = image_paths or os.getenv("VISION_TEST_IMAGES", "testburger1.jpg,testburger.jpg").split(",")
+    
+    print("\n--- Starting Structured Marketing Data Extraction ---")
+    
+    # A single image streams its reply; several are processed in parallel
+    if len(LOCAL_IMAGE_PATHS) == 1:
+        outputs = {LOCAL_IMAGE_PATHS[0]: analyze_image(LOCAL_IMAGE_PATHS[0])}
+    else:
+        outputs = extract_many(LOCAL_IMAGE_PATHS)
+    
+    for image_path, json_output in outputs.items():
+        print(f"\n--- Result for {image_path} (JSON Output for RAG Indexing) ---")
+        print_result(json_output)
+
 if __name__ == "__main__":
-    test_image_reading()
\ No newline at end of file
+    test_image_reading(sys.argv[1:])
\ No newline at end of file